@@ -0,0 +1,19 @@
+"""Gunicorn settings for POSIX deployments: gunicorn -c gunicorn.conf.py wsgi:app"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('FLASK_PORT', 5000)}"
+worker_class = 'gthread'
+threads = int(os.getenv('FLASK_THREADS', 8))
+
+# Exactly one worker: the face database journal is appended under an in-process lock
+# only, and every worker would also run its own auto-reload monitor and snapshot saves,
+# so several workers writing the same files corrupt the face database. Scale with
+# `threads` instead
+workers = 1
+
+# ONNX Runtime sessions and the inference thread do not survive fork, so every worker
+# imports the app (and initializes the model) itself instead of inheriting it
+preload_app = False
+
+# The first requests of a worker also pay for model warm-up
+timeout = 120
@@ -10,9 +10,22 @@ if __name__ == '__main__':
     # Start Flask server - Allow external connections
     host = '0.0.0.0'  # Accept connections from any IP
     port = int(os.getenv('FLASK_PORT', 5000))
+    threads = int(os.getenv('FLASK_THREADS', 8))
     
     logger.info(f"Starting Face Recognition Service on {host}:{port}")
     
-    # Run without SSL for development
-    app.run(host=host, port=port, debug=False)
+    # Serve with waitress (multi-threaded production WSGI server). A single process
+    # is kept on purpose: the face database and model live in process memory.
+    try:
+        from waitress import serve
+    except ImportError:
+        serve = None
     
+    if serve and not os.getenv('FLASK_DEV_SERVER'):
+        logger.info("Using waitress with %d threads", threads)
+        serve(app, host=host, port=port, threads=threads)
+    else:
+        # Run without SSL for development
+        if not serve:
+            logger.warning("waitress not installed, falling back to the Flask development server")
+        app.run(host=host, port=port, debug=False, threaded=True)
@@ -1,191 +1,937 @@
 import cv2
 import numpy as np
-import insightface
 from insightface.app import FaceAnalysis
+from insightface.app.common import Face
+from insightface.utils import face_align
+import onnxruntime as ort
 import os
+import glob
+import binascii
 import pickle
+import json
+import hashlib
+import threading
+import queue
+import time
 import logging
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Optional
+from collections import OrderedDict, deque
 import requests
-from io import BytesIO
-from PIL import Image
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, Future
 from datetime import datetime
 
+from similarity_kernels import best_match as small_gallery_best_match, SMALL_GALLERY_SIZE
+
+try:
+    import simsimd  # Optional SIMD similarity kernels
+except ImportError:
+    simsimd = None
+
+try:
+    import xxhash  # Optional fast hash for the recognition query cache
+except ImportError:
+    xxhash = None
+
+try:
+    import faiss  # Optional approximate nearest-neighbour index for large galleries
+except ImportError:
+    faiss = None
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Largest face image we are willing to download (bytes)
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+
+# Downloaded face images are cached here by sha256(url); set to an empty string to disable
+IMAGE_CACHE_DIR = os.getenv('ARCFACE_IMAGE_CACHE_DIR', os.path.join('.cache', 'faces'))
+
+# Cached images older than this are downloaded again, and the cache is pruned
+# (oldest first) once it grows past the size cap
+IMAGE_CACHE_MAX_AGE = int(os.getenv('ARCFACE_IMAGE_CACHE_MAX_AGE', 24 * 60 * 60))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('ARCFACE_IMAGE_CACHE_MAX_MB', 512)) * 1024 * 1024
+IMAGE_CACHE_PRUNE_EVERY = 64
+
+# Parallel image downloads when registering many faces at once
+DOWNLOAD_WORKERS = 16
+
+# Aligned face crops sent to the recognition model per batched call
+EMBEDDING_BATCH_SIZE = int(os.getenv('ARCFACE_BATCH', 32))
+
+# Recently submitted base64 images whose query embedding is kept (0 disables)
+RECOGNITION_CACHE_SIZE = int(os.getenv('ARCFACE_RECOGNITION_CACHE', 128))
+
+# Storage type of the in-memory matching gallery: float32 (default), float16 or int8
+GALLERY_DTYPE = os.getenv('ARCFACE_GALLERY_DTYPE', 'float32').lower()
+
+# Gallery size from which a faiss index replaces the linear scan, and its type:
+# 'hnsw' (approximate, sub-linear), 'flat' (exact inner-product search) or
+# 'sq8' (exhaustive search over 8-bit scalar-quantized codes, 4x less memory)
+FAISS_MIN_GALLERY = int(os.getenv('ARCFACE_FAISS_MIN_GALLERY', 10000))
+FAISS_INDEX_TYPE = os.getenv('ARCFACE_FAISS_INDEX', 'hnsw').lower()
+
+# HNSW graph breadth at build and search time; faiss's default efSearch of 16 gives
+# weak recall@1 for 512-d face identification
+HNSW_EF_CONSTRUCTION = int(os.getenv('ARCFACE_HNSW_EF_CONSTRUCTION', 200))
+HNSW_EF_SEARCH = int(os.getenv('ARCFACE_HNSW_EF_SEARCH', 128))
+
+# Symmetric int8 scale for unit-length embeddings (components lie in [-1, 1])
+INT8_SCALE = 127.0
+
+# Fixed unit-length embedding for users registered from placeholder images; these
+# entries are flagged is_mock and never enter the matching gallery
+MOCK_EMBEDDING = np.zeros(512, dtype=np.float32)
+MOCK_EMBEDDING[0] = 1.0
+MOCK_EMBEDDING.setflags(write=False)
+
+def normalize_embedding(embedding) -> np.ndarray:
+    """Return the embedding as a unit-length float32 vector"""
+    embedding = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(embedding)
+    return embedding / norm if norm > 0 else embedding
+
+def decode_base64_image(base64_image: str) -> bytes:
+    """Decode a base64 image payload, with or without a data-URI prefix
+    
+    The prefix is skipped through a memoryview and the payload handed straight to
+    binascii, so the (often ~1MB) string is copied once rather than split and re-encoded.
+    """
+    payload = memoryview(base64_image.encode('ascii'))
+    comma = base64_image.find(',')
+    return binascii.a2b_base64(payload[comma + 1:] if comma >= 0 else payload)
+
+def _json_default(value):
+    """Serialize numpy values (and anything else unexpected) in saved metadata"""
+    return value.tolist() if hasattr(value, 'tolist') else str(value)
+
+def quantize_embeddings(embeddings: np.ndarray, dtype) -> np.ndarray:
+    """Convert unit-length float embeddings to the gallery storage dtype"""
+    if np.dtype(dtype) == np.int8:
+        return np.clip(np.round(embeddings * INT8_SCALE), -127, 127).astype(np.int8)
+    return embeddings.astype(dtype, copy=False)
+
+def gallery_similarities(gallery: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Cosine similarity of a unit-length query against every row of the gallery
+    
+    float32 galleries use a NumPy matrix-vector product (BLAS GEMV is faster than
+    SimSIMD there). The query is quantized to the gallery dtype first; float16 and
+    int8 galleries use SimSIMD's half-precision and int8 kernels when it is installed.
+    """
+    if gallery.dtype == np.float32:
+        return gallery @ query
+    query = quantize_embeddings(query, gallery.dtype)
+    if simsimd is not None:
+        distances = simsimd.cdist(query.reshape(1, -1), gallery, metric='cosine')
+        return 1.0 - np.asarray(distances, dtype=np.float32).ravel()
+    if gallery.dtype == np.int8:
+        return (gallery.astype(np.int32) @ query.astype(np.int32)) / (INT8_SCALE * INT8_SCALE)
+    return gallery @ query
+
 class ArcFaceService:
+    """ArcFace enrollment and recognition over an in-memory face database
+    
+    Every embedding stored in face_database (and every query embedding) is a
+    unit-length float32 vector; normalize_embedding enforces this wherever
+    embeddings enter the service, so cosine similarity is a plain dot product.
+    """
+    
     def __init__(self):
         self.app = None
         self.face_database = {}
-        self.embeddings_file = 'face_embeddings.pkl'
+        # Embeddings are stored as one float32 (N, 512) matrix per save
+        # (face_embeddings.<generation>.npy) plus a JSON sidecar naming it, with ids
+        # and metadata; the pickle is only read to migrate older installs
+        self.embeddings_file = 'face_embeddings.npy'
+        self.metadata_file = 'face_embeddings.json'
+        self.legacy_embeddings_file = 'face_embeddings.pkl'
+        
+        # Single-face changes are appended to a journal (raw float32 rows + JSONL
+        # metadata) and folded into the snapshot above by the next full save
+        self.journal_embeddings_file = 'face_embeddings.journal.f32'
+        self.journal_metadata_file = 'face_embeddings.journal.jsonl'
+        self._journal_records = 0
+        self._persist_lock = threading.RLock()
+        
+        # float16 / int8 cut gallery memory traffic 2x / 4x but only pay off with
+        # SimSIMD's native kernels (NumPy has no fast half or int8 matmul)
+        self._gallery_dtype = 'float32'
+        if GALLERY_DTYPE in ('float16', 'int8'):
+            if simsimd is not None:
+                self._gallery_dtype = GALLERY_DTYPE
+            else:
+                logger.warning("ARCFACE_GALLERY_DTYPE=%s needs simsimd; keeping a float32 gallery", GALLERY_DTYPE)
+        
+        # Stacked (N, 512) gallery used for batched matching, rebuilt lazily when dirty.
+        # (matrix, ids, index) is published as one tuple so a reader never pairs a new
+        # matrix with old ids; rebuilds are serialized by the lock
+        self._gallery = (quantize_embeddings(np.empty((0, 512), dtype=np.float32), self._gallery_dtype), (), None)
+        self._gallery_refs = []  # face_database embedding objects behind the gallery rows
+        self._gallery_lock = threading.Lock()
+        self._gallery_rebuilding = False
+        self._gallery_dirty = True
+        self._gallery_source_size = 0  # len(face_database) when the gallery was built
         self.similarity_threshold = 0.5
+        
+        # LRU of image hash -> query embedding (None when no face was found), so
+        # re-submitted frames skip detection and recognition
+        self._recognition_cache = OrderedDict()
+        self._recognition_cache_lock = threading.Lock()
+        self._recognition_cache_hits = 0
+        self._recognition_cache_misses = 0
         self.supabase_service = None  # Will be injected
         
+        # Pooled keep-alive session shared by all image downloads
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._image_cache_writes = 0
+        self._image_cache_lock = threading.Lock()
+        
+        # Requests run concurrently on the server's threads, so per-call OpenCV/faiss
+        # thread pools stay at one thread; only the background index build uses more
+        self.set_inference_threads(1)
         self.initialize_model()
+        self._start_inference_worker()
         
     def set_supabase_service(self, supabase_service):
         """Inject supabase service for database operations"""
         self.supabase_service = supabase_service
         
+    def set_inference_threads(self, n: int):
+        """Set the OpenCV thread pool size (process-wide) and faiss's OpenMP threads
+        
+        OpenMP keeps its thread count per calling thread, so the faiss setting only
+        applies to searches and builds started from the thread that calls this; other
+        threads keep the OMP_NUM_THREADS default.
+        """
+        cv2.setNumThreads(n)
+        if faiss is not None:
+            faiss.omp_set_num_threads(n)
+    
+    def _select_providers(self, device_id: int = 0) -> List:
+        """Pick the fastest available ONNX Runtime providers, always ending with CPU
+        
+        TensorRT (FP16, with a cached engine) is only tried when ARCFACE_TENSORRT=1,
+        since building its engines makes the first start take minutes.
+        """
+        available = ort.get_available_providers()
+        providers = []
+        if os.getenv('ARCFACE_TENSORRT') == '1' and 'TensorrtExecutionProvider' in available:
+            providers.append(('TensorrtExecutionProvider', {
+                'device_id': device_id,
+                'trt_fp16_enable': True,
+                'trt_engine_cache_enable': True,
+                'trt_engine_cache_path': os.path.join('.cache', 'trt'),
+            }))
+        if 'CUDAExecutionProvider' in available:
+            providers.append(('CUDAExecutionProvider', {
+                'device_id': device_id,
+                'arena_extend_strategy': 'kNextPowerOfTwo',
+            }))
+        if 'OpenVINOExecutionProvider' in available:
+            providers.append('OpenVINOExecutionProvider')
+        return providers + ['CPUExecutionProvider']
+    
+    def _session_options(self) -> ort.SessionOptions:
+        """ONNX Runtime session options (ARCFACE_THREADS caps intra-op threads)"""
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        threads = int(os.getenv('ARCFACE_THREADS', 0))
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        return options
+    
+    def _apply_session_options(self, providers: List):
+        """Reopen every model's ONNX Runtime session with _session_options()
+        
+        insightface only forwards the providers to the sessions it creates, so the
+        session options are applied by recreating each session from its model file.
+        """
+        options = self._session_options()
+        for model in self.app.models.values():
+            model.session = ort.InferenceSession(model.model_file, sess_options=options, providers=providers)
+    
     def initialize_model(self):
-        """Initialize the ArcFace model"""
+        """Initialize the ArcFace model
+        
+        ARCFACE_CTX_ID selects the device (-1 forces CPU) and ARCFACE_DET_SIZE the
+        square detector input size.
+        """
         try:
-            self.app = FaceAnalysis(providers=['CPUExecutionProvider'])
-            self.app.prepare(ctx_id=0, det_size=(640, 640))
-            logger.info("ArcFace model initialized successfully")
+            ctx_id = int(os.getenv('ARCFACE_CTX_ID', 0))
+            providers = self._select_providers(max(ctx_id, 0))
+            det_size = int(os.getenv('ARCFACE_DET_SIZE', 640))
+            
+            # Only the models this service reads: the 106/68-point landmark models are
+            # never used (landmarks come from the detector's 5 keypoints)
+            self.app = FaceAnalysis(allowed_modules=['detection', 'recognition', 'genderage'],
+                                    providers=providers)
+            self._apply_session_options(providers)
+            self.app.prepare(ctx_id=ctx_id, det_size=(det_size, det_size))
+            applied = self.app.models['recognition'].session.get_providers()
+            logger.info("ArcFace model initialized successfully (providers: %s, det_size: %d)", applied, det_size)
         except Exception as e:
             logger.error(f"Error initializing ArcFace model: {e}")
             raise e
     
+    def _start_inference_worker(self):
+        """Start the thread that owns all model calls"""
+        self._inference_queue = queue.Queue()
+        self._inference_thread = threading.Thread(target=self._inference_loop, name='arcface-inference', daemon=True)
+        self._inference_thread.start()
+    
+    def _inference_loop(self):
+        """Run queued model calls one at a time on the inference thread
+        
+        Single-crop recognition calls that are waiting at the same time (concurrent
+        /recognize requests) are run as one batched recognition call.
+        """
+        backlog = deque()
+        while True:
+            if not backlog:
+                backlog.append(self._inference_queue.get())
+            while True:
+                try:
+                    backlog.append(self._inference_queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            fn, args, future = backlog.popleft()
+            if fn != self._embed_crop:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args))
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+            
+            # Each request waits on its own call, so pulling later crops forward
+            # never reorders calls within one request
+            batch, remaining = [(args[0], future)], deque()
+            for item in backlog:
+                if item[0] == self._embed_crop and len(batch) < EMBEDDING_BATCH_SIZE:
+                    batch.append((item[1][0], item[2]))
+                else:
+                    remaining.append(item)
+            backlog = remaining
+            self._run_crop_batch(batch)
+    
+    def _run_crop_batch(self, batch: List):
+        """Embed queued (aligned_face, future) pairs with one recognition call"""
+        batch = [(crop, future) for crop, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            features = self.app.models['recognition'].get_feat([crop for crop, _ in batch])
+            for (_, future), feature in zip(batch, features):
+                future.set_result(feature)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+    
+    def _infer(self, fn, *args):
+        """Run a model call on the inference thread and wait for its result
+        
+        Request threads keep decoding and preprocessing in parallel while the ONNX
+        sessions are only ever driven from one thread.
+        """
+        if threading.current_thread() is self._inference_thread:
+            return fn(*args)
+        future = Future()
+        self._inference_queue.put((fn, args, future))
+        return future.result()
+    
     def load_face_database(self):
         """Load existing face database from file"""
-        if os.path.exists(self.embeddings_file):
+        self.face_database = {}
+        self._gallery_dirty = True
+        
+        if os.path.exists(self.metadata_file):
             try:
-                with open(self.embeddings_file, 'rb') as f:
-                    self.face_database = pickle.load(f)
+                with open(self.metadata_file, 'r', encoding='utf-8') as f:
+                    metadata = json.load(f)
+                # Snapshots name the matrix saved with them; older ones used embeddings_file
+                if 'matrix_file' in metadata:
+                    matrix_file = os.path.join(os.path.dirname(self.metadata_file), metadata['matrix_file'])
+                else:
+                    matrix_file = self.embeddings_file
+                # Memory-map the matrix where the OS lets us delete a mapped file on the
+                # next save (POSIX); Windows cannot, so it is read into memory there
+                matrix = np.load(matrix_file, mmap_mode='r' if os.name != 'nt' else None)
+                
+                if len(metadata['ids']) != matrix.shape[0]:
+                    raise ValueError(f"{self.metadata_file} lists {len(metadata['ids'])} faces but "
+                                     f"{matrix_file} has {matrix.shape[0]}")
+                
+                for index, (user_id, entry) in enumerate(zip(metadata['ids'], metadata['entries'])):
+                    self.face_database[user_id] = {**entry, 'embedding': matrix[index]}
+                
+                # Without mock entries the saved matrix is already the matching gallery,
+                # in the same order
+                if not any(entry.get('is_mock') for entry in metadata['entries']):
+                    vectors = np.ascontiguousarray(matrix, dtype=np.float32)
+                    index = self._build_index(vectors)
+                    with self._gallery_lock:
+                        self._set_gallery(vectors, metadata['ids'],
+                                          [self.face_database[user_id]['embedding'] for user_id in metadata['ids']],
+                                          len(self.face_database), index)
+                
                 logger.info(f"Loaded {len(self.face_database)} faces from database")
             except Exception as e:
-                logger.error(f"Error loading face database: {e}")
+                logger.error("Error loading face database: %s", e)
                 self.face_database = {}
-        else:
-            self.face_database = {}
+        elif os.path.exists(self.legacy_embeddings_file):
+            try:
+                with open(self.legacy_embeddings_file, 'rb') as f:
+                    self.face_database = pickle.load(f)
+                # Older files may hold raw embeddings; similarity assumes unit vectors
+                for data in self.face_database.values():
+                    data['embedding'] = normalize_embedding(data['embedding'])
+                logger.info("Loaded %d faces from legacy database %s (migrated on next save)",
+                            len(self.face_database), self.legacy_embeddings_file)
+            except Exception as e:
+                logger.error("Error loading face database: %s", e)
+                self.face_database = {}
+        
+        self._replay_journal()
+    
+    def _replay_journal(self):
+        """Apply journaled single-face changes on top of the loaded snapshot
+        
+        A write interrupted by a crash leaves a partial trailing row or line; both are
+        cut off so the next append lands on a row boundary and a fresh line.
+        """
+        self._journal_records = 0
+        if not os.path.exists(self.journal_metadata_file):
+            return
+        
+        try:
+            rows = np.fromfile(self.journal_embeddings_file, dtype=np.float32) if os.path.exists(self.journal_embeddings_file) else np.empty(0, dtype=np.float32)
+            if rows.size % 512:
+                rows = rows[:rows.size - rows.size % 512]
+                with open(self.journal_embeddings_file, 'r+b') as f:
+                    f.truncate(rows.nbytes)
+            rows = rows.reshape(-1, 512)
+            
+            valid_bytes = 0
+            with open(self.journal_metadata_file, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('unterminated line')
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # Torn final line from an interrupted write
+                    valid_bytes += len(line)
+                    if record.get('deleted'):
+                        self.face_database.pop(record['id'], None)
+                    elif record['row'] < rows.shape[0]:
+                        self.face_database[record['id']] = {**record['entry'], 'embedding': rows[record['row']]}
+                    self._journal_records += 1
+            if valid_bytes != os.path.getsize(self.journal_metadata_file):
+                with open(self.journal_metadata_file, 'r+b') as f:
+                    f.truncate(valid_bytes)
+            
+            if self._journal_records:
+                self._gallery_dirty = True
+                logger.info("Replayed %d journaled face changes", self._journal_records)
+        except Exception as e:
+            logger.error("Error replaying face database journal: %s", e)
+    
+    def _append_to_journal(self, user_id):
+        """Persist one face (or its removal) without rewriting the whole database"""
+        with self._persist_lock:
+            try:
+                data = self.face_database.get(user_id)
+                if data is None:
+                    record = {'id': user_id, 'deleted': True}
+                else:
+                    embedding = np.asarray(data['embedding'], dtype=np.float32)
+                    with open(self.journal_embeddings_file, 'ab') as f:
+                        row, torn = divmod(f.tell(), embedding.nbytes)
+                        if torn:
+                            f.truncate(row * embedding.nbytes)  # Partial row from an interrupted write
+                        f.write(embedding.tobytes())
+                    record = {
+                        'id': user_id,
+                        'row': row,
+                        'entry': {key: value for key, value in data.items() if key != 'embedding'}
+                    }
+                
+                with open(self.journal_metadata_file, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, default=_json_default) + '\n')
+                self._journal_records += 1
+                
+                # Fold the journal into a fresh snapshot once it outgrows the database
+                if self._journal_records > max(1000, len(self.face_database)):
+                    self.save_face_database()
+            except Exception as e:
+                logger.error("Error appending to face database journal: %s", e)
     
     def save_face_database(self):
-        """Save face database to file"""
+        """Save face database to file (a full snapshot, which also clears the journal)"""
+        with self._persist_lock:
+            self._save_snapshot()
+    
+    def _save_snapshot(self):
+        """Write the snapshot files and drop the journal they now include"""
         try:
-            with open(self.embeddings_file, 'wb') as f:
-                pickle.dump(self.face_database, f)
+            ids = list(self.face_database.keys())
+            if ids:
+                matrix = np.stack([self.face_database[user_id]['embedding'] for user_id in ids]).astype(np.float32, copy=False)
+            else:
+                matrix = np.empty((0, 512), dtype=np.float32)
+            metadata = {
+                'ids': ids,
+                'entries': [
+                    {key: value for key, value in self.face_database[user_id].items() if key != 'embedding'}
+                    for user_id in ids
+                ]
+            }
+            
+            # The matrix goes to a new file named after this save, and replacing the
+            # metadata is the single step that publishes it: a crash at any point
+            # leaves the previous matrix and metadata paired
+            stem, ext = os.path.splitext(self.embeddings_file)
+            matrix_file = f"{stem}.{os.urandom(8).hex()}{ext}"
+            with open(matrix_file, 'wb') as f:
+                np.save(f, matrix)
+            metadata['matrix_file'] = os.path.basename(matrix_file)
+            metadata_tmp = self.metadata_file + '.tmp'
+            with open(metadata_tmp, 'w', encoding='utf-8') as f:
+                json.dump(metadata, f, default=_json_default)
+            os.replace(metadata_tmp, self.metadata_file)
+            
+            # Matrices of earlier (or interrupted) saves are no longer referenced
+            for old_file in glob.glob(f"{glob.escape(stem)}.*{ext}") + [self.embeddings_file]:
+                if old_file != matrix_file and os.path.exists(old_file):
+                    os.remove(old_file)
+            
+            # Metadata journal first: rows without metadata lines are ignored on replay
+            for journal_file in (self.journal_metadata_file, self.journal_embeddings_file):
+                if os.path.exists(journal_file):
+                    os.remove(journal_file)
+            self._journal_records = 0
+            
             logger.info(f"Saved {len(self.face_database)} faces to database")
         except Exception as e:
             logger.error(f"Error saving face database: {e}")
     
-    def download_image(self, url: str) -> Optional[np.ndarray]:
-        """Download image from URL and convert to OpenCV format"""
+    def _image_cache_path(self, url: str) -> Optional[str]:
+        """Local cache file for an image URL, or None when the cache is disabled"""
+        if not IMAGE_CACHE_DIR:
+            return None
+        return os.path.join(IMAGE_CACHE_DIR, hashlib.sha256(url.encode('utf-8')).hexdigest())
+    
+    def download_image(self, url: str, use_cache: bool = True) -> Optional[np.ndarray]:
+        """Download image from URL and convert to OpenCV format
+        
+        Downloaded images are kept in a local cache keyed by the URL, so registering
+        the same users again does not hit the network. Entries older than
+        IMAGE_CACHE_MAX_AGE are fetched again; use_cache=False always downloads and
+        refreshes the cached copy (a face re-uploaded under the same URL).
+        """
+        cache_path = self._image_cache_path(url)
+        if use_cache and cache_path:
+            try:
+                fresh = time.time() - os.path.getmtime(cache_path) < IMAGE_CACHE_MAX_AGE
+            except OSError:
+                fresh = False
+            if fresh:
+                try:
+                    with open(cache_path, 'rb') as f:
+                        return self.decode_image_bytes(f.read())
+                except Exception as e:
+                    logger.warning("Ignoring unreadable cached image for %s: %s", url, e)
+        
+        try:
+            image_data = self._fetch_image_bytes(url)
+            if image_data is None:
+                return None
+            opencv_image = self.decode_image_bytes(image_data)
+        except Exception as e:
+            logger.error("Error downloading image from %s: %s", url, e)
+            return None
+        
+        if cache_path:
+            self._write_image_cache(url, cache_path, image_data)
+        
+        return opencv_image
+    
+    def _write_image_cache(self, url: str, cache_path: str, image_data: bytes):
+        """Atomically store downloaded bytes and prune the cache every few writes"""
         try:
-            # Check if this looks like a Supabase Storage path
-            if not url.startswith('http') and self.supabase_service:
-                # This might be a storage path, try to download from Supabase Storage
-                logger.info(f"Attempting to download from Supabase Storage: {url}")
-                
-                # Try to download directly from storage
-                file_data = self.supabase_service.download_storage_file(url, 'user-profile')
-                if file_data:
-                    image = Image.open(BytesIO(file_data))
-                    opencv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-                    logger.info(f"Successfully downloaded image from storage: {url}")
-                    return opencv_image
-                else:
-                    # Fallback: try to get signed URL and download via HTTP
-                    signed_url = self.supabase_service.get_storage_url(url, 'user-profile')
-                    logger.info(f"Trying signed URL: {signed_url}")
-                    url = signed_url
-            
-            # Standard HTTP download
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            }
+            os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(image_data)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning("Could not cache image for %s: %s", url, e)
+            return
+        
+        with self._image_cache_lock:
+            self._image_cache_writes += 1
+            if self._image_cache_writes % IMAGE_CACHE_PRUNE_EVERY:
+                return
+        self._prune_image_cache()
+    
+    def _prune_image_cache(self):
+        """Delete expired cache files, then the oldest ones until under IMAGE_CACHE_MAX_BYTES"""
+        try:
+            entries = []
+            now = time.time()
+            with os.scandir(IMAGE_CACHE_DIR) as it:
+                for entry in it:
+                    if not entry.is_file() or entry.name.endswith('.tmp'):
+                        continue
+                    stat = entry.stat()
+                    if now - stat.st_mtime >= IMAGE_CACHE_MAX_AGE:
+                        os.remove(entry.path)
+                    else:
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
             
-            response = requests.get(url, timeout=30, headers=headers)
-            if response.status_code == 200:
-                image = Image.open(BytesIO(response.content))
-                # Convert PIL image to OpenCV format
-                opencv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-                logger.info(f"Successfully downloaded image from URL: {url[:100]}...")
-                return opencv_image
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= IMAGE_CACHE_MAX_BYTES:
+                    break
+                os.remove(path)
+                total -= size
+        except OSError as e:
+            logger.warning("Could not prune image cache: %s", e)
+    
+    def _fetch_image_bytes(self, url: str) -> Optional[bytes]:
+        """Fetch the encoded image bytes from Supabase Storage or over HTTP"""
+        # Check if this looks like a Supabase Storage path
+        if not url.startswith('http') and self.supabase_service:
+            # This might be a storage path, try to download from Supabase Storage
+            logger.info("Attempting to download from Supabase Storage: %s", url)
+            
+            # Try to download directly from storage
+            file_data = self.supabase_service.download_storage_file(url, 'user-profile')
+            if file_data:
+                logger.info("Successfully downloaded image from storage: %s", url)
+                return file_data
             else:
-                logger.error(f"Failed to download image from {url}, status code: {response.status_code}")
+                # Fallback: try to get signed URL and download via HTTP
+                signed_url = self.supabase_service.get_storage_url(url, 'user-profile')
+                logger.info("Trying signed URL: %s", signed_url)
+                url = signed_url
+        
+        # Standard HTTP download
+        headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+            'Accept': 'image/*'
+        }
+        
+        # Stream the body so bad or oversized responses are rejected from the headers
+        with self._session.get(url, timeout=30, headers=headers, stream=True) as response:
+            if response.status_code != 200:
+                logger.error("Failed to download image from %s, status code: %s", url, response.status_code)
                 return None
-        except Exception as e:
-            logger.error(f"Error downloading image from {url}: {e}")
+            
+            content_type = response.headers.get('Content-Type', '')
+            if content_type and not content_type.startswith(('image/', 'application/octet-stream')):
+                logger.error("Skipping %s: not an image (Content-Type: %s)", url, content_type)
+                return None
+            
+            content_length = int(response.headers.get('Content-Length') or 0)
+            if content_length > MAX_IMAGE_BYTES:
+                logger.error("Skipping %s: image too large (%d bytes)", url, content_length)
+                return None
+            
+            # Content-Length may be missing or wrong, so enforce the cap while reading too
+            body = bytearray()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                body.extend(chunk)
+                if len(body) > MAX_IMAGE_BYTES:
+                    logger.error("Skipping %s: image exceeds %d bytes", url, MAX_IMAGE_BYTES)
+                    return None
+        
+        logger.info("Successfully downloaded image from URL: %.100s...", url)
+        return bytes(body)
+    
+    def align_best_face(self, image: np.ndarray) -> Optional[np.ndarray]:
+        """Detect faces and return the aligned 112x112 crop of the most confident one"""
+        bboxes, kpss = self._infer(self.app.det_model.detect, image)
+        if bboxes.shape[0] == 0 or kpss is None:
+            logger.warning("No face detected in image")
             return None
+        best = int(bboxes[:, 4].argmax())
+        return face_align.norm_crop(image, landmark=kpss[best], image_size=self.app.models['recognition'].input_size[0])
+    
+    def _embed_crop(self, aligned_face: np.ndarray) -> np.ndarray:
+        """Recognition features of one aligned crop (batched with others by the inference loop)"""
+        return self.app.models['recognition'].get_feat(aligned_face)[0]
+    
+    def extract_embedding_from_crop(self, aligned_face: np.ndarray) -> np.ndarray:
+        """Embed an already aligned 112x112 face crop, skipping detection entirely"""
+        feature = self._infer(self._embed_crop, aligned_face)
+        return normalize_embedding(feature.ravel())
     
     def extract_face_embedding(self, image: np.ndarray) -> Optional[np.ndarray]:
-        """Extract face embedding from image using ArcFace"""
+        """Extract face embedding from image using ArcFace
+        
+        Only the detector and the recognition model run; the landmark and gender/age
+        models that FaceAnalysis.get would also run are not needed for an embedding.
+        """
         try:
-            faces = self.app.get(image)
-            if len(faces) > 0:
-                # Get the face with highest confidence
-                face = max(faces, key=lambda x: x.det_score)
-                return face.normed_embedding
-            else:
-                logger.warning("No face detected in image")
+            if 'recognition' not in self.app.models:
+                faces = self._infer(self.app.get, image)
+                if len(faces) == 0:
+                    logger.warning("No face detected in image")
+                    return None
+                return normalize_embedding(max(faces, key=lambda x: x.det_score).normed_embedding)
+            
+            # Get the face with highest confidence
+            aligned_face = self.align_best_face(image)
+            if aligned_face is None:
                 return None
+            return self.extract_embedding_from_crop(aligned_face)
         except Exception as e:
             logger.error(f"Error extracting face embedding: {e}")
             return None
     
+    def extract_face_embeddings_batch(self, images: List[Optional[np.ndarray]]) -> List[Optional[np.ndarray]]:
+        """Extract one face embedding per image, running recognition as a single batch
+        
+        Detection still runs per image, but the aligned 112x112 crops of the best face
+        in each image go through the recognition model together. Entries are None where
+        the image is missing or has no face.
+        """
+        embeddings = [None] * len(images)
+        recognition = self.app.models.get('recognition')
+        if recognition is None:
+            return [self.extract_face_embedding(image) if image is not None else None for image in images]
+        
+        crops, crop_indexes = [], []
+        for index, image in enumerate(images):
+            if image is None:
+                continue
+            try:
+                aligned_face = self.align_best_face(image)
+                if aligned_face is not None:
+                    crops.append(aligned_face)
+                    crop_indexes.append(index)
+            except Exception as e:
+                logger.error("Error detecting face: %s", e)
+        
+        try:
+            for start in range(0, len(crops), EMBEDDING_BATCH_SIZE):
+                features = self._infer(recognition.get_feat, crops[start:start + EMBEDDING_BATCH_SIZE])
+                for index, feature in zip(crop_indexes[start:start + EMBEDDING_BATCH_SIZE], features):
+                    embeddings[index] = normalize_embedding(feature)
+        except Exception as e:
+            logger.error("Error extracting face embeddings: %s", e)
+        
+        return embeddings
+    
+    def _face_info_dict(self, face: Face, embedding: np.ndarray) -> Dict:
+        """Build the face information dict stored for an enrolled face"""
+        return {
+            'embedding': normalize_embedding(embedding),
+            # Kept as float32 arrays; they become lists only when serialized to JSON
+            'bbox': face.bbox.astype(np.float32, copy=False),  # Bounding box [x1, y1, x2, y2]
+            'landmarks': (face.kps.astype(np.float32, copy=False) if getattr(face, 'kps', None) is not None
+                          else np.empty((0, 2), dtype=np.float32)),  # 5 facial landmarks
+            'confidence': float(face.det_score),
+            'age': int(face.age) if face.age is not None else None,
+            'gender': face.sex
+        }
+    
+    def _face_record(self, face_info: Dict, user_data: Dict, enrolled_at: str, **extra) -> Dict:
+        """Build the face_database entry for an enrolled face (extra keys record its source)"""
+        return {
+            'embedding': face_info['embedding'],
+            'user_data': user_data,
+            'face_info': {key: face_info[key] for key in ('bbox', 'landmarks', 'confidence', 'age', 'gender')},
+            'enrolled_at': enrolled_at,
+            **extra
+        }
+    
     def extract_face_info(self, image: np.ndarray) -> Optional[Dict]:
         """Extract comprehensive face information including embedding and landmarks"""
         try:
-            faces = self.app.get(image)
+            faces = self._infer(self.app.get, image)
             if len(faces) > 0:
                 # Get the face with highest confidence
                 face = max(faces, key=lambda x: x.det_score)
-                
-                return {
-                    'embedding': face.normed_embedding,
-                    'bbox': face.bbox.tolist(),  # Bounding box [x1, y1, x2, y2]
-                    'landmarks': face.kps.tolist() if hasattr(face, 'kps') and face.kps is not None else [],  # 5 facial landmarks
-                    'confidence': float(face.det_score),
-                    'age': int(face.age) if hasattr(face, 'age') else None,
-                    'gender': face.sex if hasattr(face, 'sex') else None
-                }
+                return self._face_info_dict(face, face.normed_embedding)
             else:
                 logger.warning("No face detected in image")
                 return None
         except Exception as e:
-            logger.error(f"Error extracting face info: {e}")
+            logger.error("Error extracting face info: %s", e)
             return None
     
-    def register_user_face(self, user_id: str, user_data: Dict, image_url: str) -> bool:
-        """Register a user's face in the database"""
+    def extract_face_info_batch(self, images: List[Optional[np.ndarray]]) -> List[Optional[Dict]]:
+        """Extract face information for several images, batching the recognition model
+        
+        Detection and gender/age still run per face; the aligned crops are embedded
+        together. Entries are None where the image is missing or has no face.
+        """
+        recognition = self.app.models.get('recognition')
+        if recognition is None:
+            return [self.extract_face_info(image) if image is not None else None for image in images]
+        
+        genderage = self.app.models.get('genderage')
+        faces, crops, face_indexes = [], [], []
+        for index, image in enumerate(images):
+            if image is None:
+                continue
+            try:
+                bboxes, kpss = self._infer(self.app.det_model.detect, image)
+                if bboxes.shape[0] == 0 or kpss is None:
+                    logger.warning("No face detected in image")
+                    continue
+                # Get the face with highest confidence
+                best = int(bboxes[:, 4].argmax())
+                face = Face(bbox=bboxes[best, 0:4], kps=kpss[best], det_score=bboxes[best, 4])
+                if genderage is not None:
+                    self._infer(genderage.get, image, face)
+                faces.append(face)
+                crops.append(face_align.norm_crop(image, landmark=face.kps, image_size=recognition.input_size[0]))
+                face_indexes.append(index)
+            except Exception as e:
+                logger.error("Error extracting face info: %s", e)
+        
+        face_infos = [None] * len(images)
+        try:
+            for start in range(0, len(crops), EMBEDDING_BATCH_SIZE):
+                features = self._infer(recognition.get_feat, crops[start:start + EMBEDDING_BATCH_SIZE])
+                batch = zip(face_indexes[start:start + EMBEDDING_BATCH_SIZE], faces[start:start + EMBEDDING_BATCH_SIZE], features)
+                for index, face, feature in batch:
+                    face_infos[index] = self._face_info_dict(face, feature)
+        except Exception as e:
+            logger.error("Error extracting face info: %s", e)
+        
+        return face_infos
+    
+    def _iter_user_face_infos(self, users: List[Dict]):
+        """Yield (user, downloaded, face_info) for each user, in order
+        
+        Images are downloaded concurrently and analysed a batch of users at a time
+        so the recognition model runs batched. Users without a face URL yield
+        (user, False, None) without any download.
+        """
+        image_urls = [user['faceScannedUrl'] if (user.get('faceScannedUrl') or '').strip() else None for user in users]
+        batches = (users[start:start + EMBEDDING_BATCH_SIZE] for start in range(0, len(users), EMBEDDING_BATCH_SIZE))
+        
+        for batch, images in zip(batches, self._download_in_batches(image_urls)):
+            face_infos = self.extract_face_info_batch(images)
+            for user, image, face_info in zip(batch, images, face_infos):
+                yield user, image is not None, face_info
+    
+    def register_user_face(self, user_id: str, user_data: Dict, image_url: str, embedding_cache: Optional[Dict] = None,
+                           use_image_cache: bool = True) -> bool:
+        """Register a user's face in the database
+        
+        embedding_cache, when given, maps image URLs to embeddings already
+        extracted in the current run so shared images are only processed once.
+        use_image_cache=False downloads the image again instead of reading the
+        local image cache.
+        """
         try:
             # Skip processing for placeholder/mock images
-            if 'placeholder' in image_url.lower() or 'via.placeholder' in image_url.lower():
-                logger.info(f"Skipping placeholder image for user {user_id}")
-                # Create a mock embedding for development
-                mock_embedding = np.random.rand(512).astype(np.float32)
+            if self._is_placeholder_url(image_url):
+                logger.info("Skipping placeholder image for user %s", user_id)
                 self.face_database[user_id] = {
-                    'embedding': mock_embedding,
-                    'user_data': user_data
+                    'embedding': MOCK_EMBEDDING,
+                    'user_data': user_data,
+                    'is_mock': True
                 }
-                logger.info(f"Registered mock face for user {user_id}")
+                self._gallery_dirty = True
+                logger.info("Registered mock face for user %s", user_id)
                 return True
             
-            # Download and process image
-            image = self.download_image(image_url)
-            if image is None:
-                return False
-            
-            # Extract face embedding
-            embedding = self.extract_face_embedding(image)
-            if embedding is None:
-                return False
+            if embedding_cache is not None and image_url in embedding_cache:
+                # A cached None means the image already failed in this run
+                embedding = embedding_cache[image_url]
+                if embedding is None:
+                    return False
+            else:
+                # Download and process image
+                image = self.download_image(image_url, use_cache=use_image_cache)
+                embedding = self.extract_face_embedding(image) if image is not None else None
+                
+                if embedding_cache is not None:
+                    embedding_cache[image_url] = embedding
+                if embedding is None:
+                    return False
             
             # Store in database
             self.face_database[user_id] = {
                 'embedding': embedding,
                 'user_data': user_data
             }
+            self._gallery_dirty = True
             
-            logger.info(f"Registered face for user {user_id}")
+            logger.info("Registered face for user %s", user_id)
             return True
             
         except Exception as e:
-            logger.error(f"Error registering user face: {e}")
+            logger.error("Error registering user face: %s", e)
             return False
     
-    def register_multiple_faces(self, users_data: List[Dict]) -> int:
-        """Register multiple users' faces"""
+    def _is_placeholder_url(self, image_url: str) -> bool:
+        """Check whether an image URL is a development placeholder"""
+        return 'placeholder' in image_url.lower()
+    
+    def _download_in_batches(self, image_urls: List[Optional[str]], use_image_cache: bool = True):
+        """Yield the downloaded images for each batch of EMBEDDING_BATCH_SIZE URLs
+        
+        Downloads are I/O bound and run on a thread pool over the pooled session. The
+        next batch is already downloading while the caller processes the current one,
+        and only about two batches of decoded images are held in memory at a time.
+        Empty URLs yield None without a download.
+        """
+        batches = [image_urls[start:start + EMBEDDING_BATCH_SIZE] for start in range(0, len(image_urls), EMBEDDING_BATCH_SIZE)]
+        
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            def submit(batch):
+                return [executor.submit(self.download_image, url, use_image_cache) if url else None for url in batch]
+            
+            pending = submit(batches[0]) if batches else []
+            for index in range(len(batches)):
+                futures = pending
+                if index + 1 < len(batches):
+                    pending = submit(batches[index + 1])
+                yield [future.result() if future else None for future in futures]
+    
+    def _prefetch_embeddings(self, image_urls: List[str], embedding_cache: Dict, use_image_cache: bool = True):
+        """Download images concurrently and fill embedding_cache with their embeddings
+        
+        Embedding extraction stays on the calling thread and batches each group of
+        images through the recognition model.
+        """
+        batches = (image_urls[start:start + EMBEDDING_BATCH_SIZE] for start in range(0, len(image_urls), EMBEDDING_BATCH_SIZE))
+        for batch, images in zip(batches, self._download_in_batches(image_urls, use_image_cache)):
+            for image_url, embedding in zip(batch, self.extract_face_embeddings_batch(images)):
+                embedding_cache[image_url] = embedding
+    
+    def register_multiple_faces(self, users_data: List[Dict], use_image_cache: bool = True) -> int:
+        """Register multiple users' faces
+        
+        Pass use_image_cache=False to download every image again, e.g. on refresh.
+        """
         success_count = 0
+        embedding_cache = {}  # Users sharing the same image URL are downloaded once
+        
+        image_urls = list(dict.fromkeys(
+            user['faceScannedUrl'] for user in users_data
+            if user.get('faceScannedUrl') and not self._is_placeholder_url(user['faceScannedUrl'])
+        ))
+        self._prefetch_embeddings(image_urls, embedding_cache, use_image_cache)
         
         for user in users_data:
             if user.get('faceScannedUrl'):
                 success = self.register_user_face(
                     user['id'], 
                     user, 
-                    user['faceScannedUrl']
+                    user['faceScannedUrl'],
+                    embedding_cache
                 )
                 if success:
                     success_count += 1
@@ -194,19 +940,124 @@ class ArcFaceService:
         logger.info(f"Successfully registered {success_count} out of {len(users_data)} users")
         return success_count
     
-    def calculate_similarity(self, embedding1: np.ndarray, embedding2: np.ndarray) -> float:
-        """Calculate cosine similarity between two embeddings"""
+    def _build_index(self, vectors: np.ndarray, previous=None):
+        """Build the faiss index for a float32 (N, 512) gallery, or None below FAISS_MIN_GALLERY
+        
+        previous is the index being replaced; an sq8 index reuses its trained value ranges.
+        """
+        if faiss is None or vectors.shape[0] < FAISS_MIN_GALLERY:
+            return None
+        
+        # Inner product on unit vectors is cosine similarity
+        dim = vectors.shape[1]
+        if FAISS_INDEX_TYPE == 'flat':
+            index = faiss.IndexFlatIP(dim)
+        elif FAISS_INDEX_TYPE == 'sq8':
+            if isinstance(previous, faiss.IndexScalarQuantizer):
+                # Unit-vector components keep the same range, so the old training holds
+                index = faiss.clone_index(previous)
+                index.reset()
+            else:
+                index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+                # Learns the per-dimension value range the 8-bit codes are spread over
+                index.train(vectors)
+        else:
+            index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+        index.add(vectors)
+        return index
+    
+    def _set_gallery(self, vectors: np.ndarray, ids: List, refs: List, source_size: int, index=None):
+        """Publish a gallery built from float32 (N, 512) vectors, their ids and faiss index
+        
+        refs are the face_database embedding objects behind each row and source_size the
+        face_database size the gallery was built from. Callers hold _gallery_lock.
+        """
+        self._gallery = (quantize_embeddings(vectors, self._gallery_dtype), tuple(ids), index)
+        self._gallery_refs = refs
+        self._gallery_source_size = source_size
+    
+    def _get_gallery(self):
+        """Return (matrix, ids, index) for the current face database, updating it if it changed
+        
+        index is a faiss index (HNSW, flat or sq8) for large galleries, otherwise None.
+        Mock (placeholder) faces are left out so they can never be matched.
+        """
+        if self._gallery_dirty or self._gallery_source_size != len(self.face_database):
+            with self._gallery_lock:
+                if self._gallery_rebuilding:
+                    # A background rebuild swaps in soon; keep serving the current gallery
+                    return self._gallery
+                # Another request may have updated it while this one waited for the lock
+                if self._gallery_dirty or self._gallery_source_size != len(self.face_database):
+                    # Cleared before the snapshot: a change landing after it marks the
+                    # gallery dirty again instead of being lost
+                    self._gallery_dirty = False
+                    # list() copies the items in one step, so enrollments on other threads
+                    # cannot change the dict while it is being iterated
+                    items = list(self.face_database.items())
+                    entries = [(user_id, data['embedding']) for user_id, data in items if not data.get('is_mock')]
+                    self._update_gallery(entries, len(items))
+        return self._gallery
+    
+    def _update_gallery(self, entries: List, source_size: int):
+        """Bring the gallery up to date with (user_id, embedding) entries; holds _gallery_lock
+        
+        Pure additions extend the current gallery (and a copy of its faiss index) in
+        place of a rebuild. Removals and re-enrollments rebuild it; large galleries are
+        rebuilt on a background thread while the current one keeps serving, or, when
+        there is no index yet, while the new rows are served by a linear scan.
+        """
+        matrix, ids, index = self._gallery
+        count = len(self._gallery_refs)
+        ids_list = [user_id for user_id, _ in entries]
+        refs = [embedding for _, embedding in entries]
+        
+        only_added = (len(entries) >= count
+                      and all(refs[i] is self._gallery_refs[i] and ids_list[i] == ids[i] for i in range(count)))
+        needs_first_index = faiss is not None and index is None and len(entries) >= FAISS_MIN_GALLERY
+        if only_added and not needs_first_index:
+            if len(entries) > count:
+                added = np.stack(refs[count:]).astype(np.float32, copy=False)
+                if index is not None:
+                    # Requests searching the published index keep using it; the copy gets the new rows
+                    index = faiss.clone_index(index)
+                    index.add(added)
+                # Mixing dtypes would upcast quantized rows and scale int8 similarities by 127
+                assert matrix.dtype == np.dtype(self._gallery_dtype), matrix.dtype
+                matrix = np.concatenate([matrix, quantize_embeddings(added, self._gallery_dtype)])
+            self._gallery = (matrix, tuple(ids_list), index)
+            self._gallery_refs = refs
+            self._gallery_source_size = source_size
+            return
+        
+        vectors = np.stack(refs).astype(np.float32, copy=False) if refs else np.empty((0, 512), dtype=np.float32)
+        if faiss is not None and len(entries) >= FAISS_MIN_GALLERY:
+            if index is None:
+                # No index to keep serving: publish the new rows for a linear scan now
+                # and swap the index in when it is built
+                self._set_gallery(vectors, ids_list, refs, source_size)
+            self._gallery_rebuilding = True
+            threading.Thread(target=self._rebuild_gallery, args=(vectors, ids_list, refs, source_size, index),
+                             name='gallery-rebuild', daemon=True).start()
+        else:
+            self._set_gallery(vectors, ids_list, refs, source_size)
+    
+    def _rebuild_gallery(self, vectors: np.ndarray, ids: List, refs: List, source_size: int, previous_index):
+        """Build a large gallery's faiss index off the request path and swap it in"""
         try:
-            # Normalize embeddings
-            embedding1 = embedding1 / np.linalg.norm(embedding1)
-            embedding2 = embedding2 / np.linalg.norm(embedding2)
-            
-            # Calculate cosine similarity
-            similarity = np.dot(embedding1, embedding2)
-            return float(similarity)
+            # Only this thread's OpenMP setting changes, so request threads stay at one
+            faiss.omp_set_num_threads(os.cpu_count() or 1)
+            index = self._build_index(vectors, previous_index)
+            with self._gallery_lock:
+                self._set_gallery(vectors, ids, refs, source_size, index)
+            logger.info("Rebuilt the faiss gallery index with %d faces", len(ids))
         except Exception as e:
-            logger.error(f"Error calculating similarity: {e}")
-            return 0.0
+            logger.error("Error rebuilding the faiss gallery index: %s", e)
+            self._gallery_dirty = True  # Retried by the next recognition
+        finally:
+            self._gallery_rebuilding = False
     
     def recognize_face_from_image(self, image: np.ndarray) -> Optional[Dict]:
         """Recognize face from image"""
@@ -215,40 +1066,102 @@ class ArcFaceService:
             query_embedding = self.extract_face_embedding(image)
             if query_embedding is None:
                 return None
-            
-            best_match = None
-            best_similarity = 0.0
-            
-            # Compare with all registered faces
-            for user_id, data in self.face_database.items():
-                stored_embedding = data['embedding']
-                similarity = self.calculate_similarity(query_embedding, stored_embedding)
-                
-                if similarity > best_similarity and similarity > self.similarity_threshold:
-                    best_similarity = similarity
-                    best_match = {
-                        'user_id': user_id,
-                        'user_data': data['user_data'],
-                        'similarity': similarity
-                    }
-            
-            return best_match
+            return self._match_embedding(query_embedding)
             
         except Exception as e:
-            logger.error(f"Error recognizing face: {e}")
+            logger.error("Error recognizing face: %s", e)
             return None
     
-    def recognize_face_from_base64(self, base64_image: str) -> Optional[Dict]:
-        """Recognize face from base64 encoded image"""
+    def _match_embedding(self, query_embedding: np.ndarray) -> Optional[Dict]:
+        """Find the registered face most similar to a query embedding, if above the threshold"""
+        matches = self._rank_matches(query_embedding, 1)
+        return matches[0] if matches else None
+    
+    def _rank_matches(self, query_embedding: np.ndarray, k: int) -> List[Dict]:
+        """Up to k registered faces above the threshold for a query embedding, most similar first"""
+        gallery, gallery_ids, gallery_index = self._get_gallery()
+        k = min(k, len(gallery_ids))
+        if k <= 0:
+            return []
+        
+        if gallery_index is not None:
+            # Large gallery: faiss nearest neighbour search
+            scores, indexes = gallery_index.search(query_embedding.reshape(1, -1), k)
+            ranked = [(int(i), float(score)) for i, score in zip(indexes[0], scores[0]) if i >= 0]
+        elif k == 1 and small_gallery_best_match is not None and len(gallery_ids) < SMALL_GALLERY_SIZE and gallery.dtype == np.float32:
+            # Small gallery: fused dot + argmax kernel avoids the BLAS call overhead
+            best_index, best_similarity = small_gallery_best_match(gallery, query_embedding)
+            ranked = [(int(best_index), float(best_similarity))] if best_index >= 0 else []
+        else:
+            # Compare with all registered faces in one matrix-vector product
+            similarities = gallery_similarities(gallery, query_embedding)
+            if k == 1:
+                top = [int(similarities.argmax())]
+            else:
+                # argpartition selects the top k in O(N); only those k are sorted
+                top = np.argpartition(similarities, -k)[-k:]
+                top = top[np.argsort(-similarities[top])]
+            ranked = [(int(i), float(similarities[i])) for i in top]
+        
+        matches = []
+        for best_index, similarity in ranked:
+            if similarity <= self.similarity_threshold or similarity <= 0.0:
+                break
+            user_id = gallery_ids[best_index]
+            data = self.face_database.get(user_id)
+            if data is None:
+                continue  # Removed after this gallery was built
+            matches.append({
+                'user_id': user_id,
+                'user_data': data['user_data'],
+                'similarity': similarity
+            })
+        return matches
+    
+    def recognize_top_k(self, image: np.ndarray, k: int = 5) -> List[Dict]:
+        """Return up to k registered faces above the threshold, most similar first"""
         try:
-            # Decode base64 image
-            import base64
-            image_data = base64.b64decode(base64_image.split(',')[1] if ',' in base64_image else base64_image)
-            image = Image.open(BytesIO(image_data))
-            opencv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+            query_embedding = self.extract_face_embedding(image)
+            if query_embedding is None:
+                return []
+            return self._rank_matches(query_embedding, k)
             
-            # Use real face recognition
-            return self.recognize_face_from_image(opencv_image)
+        except Exception as e:
+            logger.error("Error recognizing top-%d faces: %s", k, e)
+            return []
+    
+    def _cached_query_embedding(self, image_data: bytes) -> Optional[np.ndarray]:
+        """Query embedding for encoded image bytes, reusing it for recently seen images"""
+        if RECOGNITION_CACHE_SIZE <= 0:
+            return self.extract_face_embedding(self.decode_image_bytes(image_data))
+        
+        key = xxhash.xxh64_intdigest(image_data) if xxhash is not None else hashlib.blake2b(image_data, digest_size=8).digest()
+        with self._recognition_cache_lock:
+            if key in self._recognition_cache:
+                self._recognition_cache_hits += 1
+                self._recognition_cache.move_to_end(key)
+                return self._recognition_cache[key]
+            self._recognition_cache_misses += 1
+        
+        embedding = self.extract_face_embedding(self.decode_image_bytes(image_data))
+        with self._recognition_cache_lock:
+            self._recognition_cache[key] = embedding
+            if len(self._recognition_cache) > RECOGNITION_CACHE_SIZE:
+                self._recognition_cache.popitem(last=False)
+        return embedding
+    
+    def recognize_face_from_base64(self, base64_image: str) -> Optional[Dict]:
+        """Recognize face from base64 encoded image
+        
+        Only the query embedding is cached, so repeated frames are still matched
+        against the current face database.
+        """
+        try:
+            image_data = decode_base64_image(base64_image)
+            query_embedding = self._cached_query_embedding(image_data)
+            if query_embedding is None:
+                return None
+            return self._match_embedding(query_embedding)
             
         except Exception as e:
             logger.error(f"Error recognizing face from base64: {e}")
@@ -256,9 +1169,45 @@ class ArcFaceService:
     
     def get_database_stats(self) -> Dict:
         """Get statistics about the face database"""
+        lookups = self._recognition_cache_hits + self._recognition_cache_misses
         return {
             'total_faces': len(self.face_database),
-            'threshold': self.similarity_threshold
+            'threshold': self.similarity_threshold,
+            'recognition_cache': {
+                'size': len(self._recognition_cache),
+                'hits': self._recognition_cache_hits,
+                'misses': self._recognition_cache_misses,
+                'hit_rate': self._recognition_cache_hits / lookups if lookups else 0.0
+            }
+        }
+    
+    def decode_image_bytes(self, image_data: bytes) -> np.ndarray:
+        """Decode encoded image bytes (JPEG/PNG/...) into an OpenCV BGR image"""
+        # imdecode returns BGR directly, skipping the PIL decode, array copy and color pass
+        image = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Could not decode image data")
+        return image
+    
+    def _enrollment_failed(self, user_detail_id: str, user_id: str, error_msg: str, start_time: datetime) -> Dict:
+        """Log a failed API enrollment and build the error result"""
+        processing_time = (datetime.now() - start_time).total_seconds() * 1000
+        
+        if self.supabase_service:
+            self.supabase_service.log_face_enrollment(
+                user_detail_id, user_id,
+                {
+                    'enrollment_status': 'failed',
+                    'face_count_detected': 0,
+                    'error_message': error_msg,
+                    'image_source': 'api',
+                    'processing_time_ms': int(processing_time)
+                }
+            )
+        
+        return {
+            'success': False,
+            'message': error_msg
         }
     
     def enroll_face_from_base64(self, user_detail_id: str, user_id: str, base64_image: str, user_data: Dict = None) -> Dict:
@@ -266,71 +1215,108 @@ class ArcFaceService:
         start_time = datetime.now()
         
         try:
-            # Decode base64 image
-            import base64
-            image_data = base64.b64decode(base64_image.split(',')[1] if ',' in base64_image else base64_image)
-            image = Image.open(BytesIO(image_data))
-            opencv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-            
+            image_data = decode_base64_image(base64_image)
+        except Exception as e:
+            error_msg = f"Error enrolling face: {str(e)}"
+            logger.error(error_msg)
+            return self._enrollment_failed(user_detail_id, user_id, error_msg, start_time)
+        
+        return self.enroll_face_from_bytes(user_detail_id, user_id, image_data, user_data, start_time)
+    
+    def enroll_face_from_url(self, user_detail_id: str, user_id: str, image_url: str, user_data: Dict = None) -> Dict:
+        """Enroll a new face by fetching the image from a URL (or storage path) server-side"""
+        start_time = datetime.now()
+        
+        opencv_image = self.download_image(image_url, use_cache=False)
+        if opencv_image is None:
+            error_msg = "Error enrolling face: could not download image"
+            logger.error("%s from %s", error_msg, image_url)
+            return self._enrollment_failed(user_detail_id, user_id, error_msg, start_time)
+        
+        return self.enroll_face_from_image(user_detail_id, user_id, opencv_image, user_data, start_time, source_url=image_url)
+    
+    def enroll_faces_batch(self, enrollments: List[Dict]) -> List[Dict]:
+        """Enroll several faces from raw image bytes or base64 images
+        
+        Each enrollment is a dict with 'user_detail_id', 'user_id', either 'image_data'
+        (bytes) or 'image' (base64) and optional 'user_data'. Returns one result per
+        enrollment; an image that cannot be decoded only fails its own entry. Each
+        enrolled face is appended to the local database journal.
+        """
+        results = []
+        
+        for enrollment in enrollments:
+            if 'image_data' in enrollment:
+                result = self.enroll_face_from_bytes(
+                    enrollment['user_detail_id'],
+                    enrollment['user_id'],
+                    enrollment['image_data'],
+                    enrollment.get('user_data')
+                )
+            else:
+                result = self.enroll_face_from_base64(
+                    enrollment['user_detail_id'],
+                    enrollment['user_id'],
+                    enrollment['image'],
+                    enrollment.get('user_data')
+                )
+            result['user_detail_id'] = enrollment['user_detail_id']
+            results.append(result)
+        
+        return results
+    
+    def enroll_face_from_bytes(self, user_detail_id: str, user_id: str, image_data: bytes, user_data: Dict = None, start_time: datetime = None) -> Dict:
+        """Enroll a new face from raw image bytes with database integration"""
+        start_time = start_time or datetime.now()
+        
+        try:
+            opencv_image = self.decode_image_bytes(image_data)
+        except Exception as e:
+            error_msg = f"Error enrolling face: {str(e)}"
+            logger.error(error_msg)
+            return self._enrollment_failed(user_detail_id, user_id, error_msg, start_time)
+        
+        return self.enroll_face_from_image(user_detail_id, user_id, opencv_image, user_data, start_time)
+    
+    def enroll_face_from_image(self, user_detail_id: str, user_id: str, opencv_image: np.ndarray, user_data: Dict = None,
+                               start_time: datetime = None, source_url: str = None) -> Dict:
+        """Enroll a new face from a decoded BGR image with database integration"""
+        start_time = start_time or datetime.now()
+        
+        try:
             # Extract face information
             face_info = self.extract_face_info(opencv_image)
             
             processing_time = (datetime.now() - start_time).total_seconds() * 1000
             
             if face_info is None:
-                # Log failed enrollment
-                if self.supabase_service:
-                    self.supabase_service.log_face_enrollment(
-                        user_detail_id, user_id,
-                        {
-                            'enrollment_status': 'failed',
-                            'face_count_detected': 0,
-                            'error_message': 'No face detected in image',
-                            'image_source': 'api',
-                            'processing_time_ms': int(processing_time)
-                        }
-                    )
-                
-                return {
-                    'success': False,
-                    'message': 'No face detected in image'
-                }
+                return self._enrollment_failed(user_detail_id, user_id, 'No face detected in image', start_time)
             
             # Store in local database for quick access
-            self.face_database[user_detail_id] = {
-                'embedding': face_info['embedding'],
-                'user_data': user_data or {},
-                'face_info': {
-                    'bbox': face_info['bbox'],
-                    'landmarks': face_info['landmarks'],
-                    'confidence': face_info['confidence'],
-                    'age': face_info['age'],
-                    'gender': face_info['gender']
-                },
-                'enrolled_at': datetime.now().isoformat(),
-                'user_detail_id': user_detail_id,
-                'user_id': user_id
-            }
+            record = self._face_record(face_info, user_data or {}, datetime.now().isoformat(),
+                                       user_detail_id=user_detail_id, user_id=user_id)
+            self.face_database[user_detail_id] = record
+            self._gallery_dirty = True
             
             # Save to file
-            self.save_face_database()
+            self._append_to_journal(user_detail_id)
             
             # Save to database if supabase service is available
             if self.supabase_service:
                 # Save face embedding
-                embedding_result = self.supabase_service.save_face_embedding(
+                self.supabase_service.save_face_embedding(
                     user_detail_id, user_id,
                     {
                         'embedding': face_info['embedding'],
                         'confidence': face_info['confidence'],
                         'face_quality_score': face_info['confidence'],  # Use confidence as quality score
-                        'source_url': user_data.get('faceScannedUrl', '') if user_data else '',
+                        'source_url': source_url or (user_data.get('faceScannedUrl', '') if user_data else ''),
                         'enrollment_method': 'api'
                     }
                 )
                 
                 # Save face landmarks
-                landmarks_result = self.supabase_service.save_face_landmarks(
+                self.supabase_service.save_face_landmarks(
                     user_detail_id, user_id,
                     {
                         'landmarks': face_info['landmarks'],
@@ -352,49 +1338,26 @@ class ArcFaceService:
                     }
                 )
             
-            logger.info(f"Successfully enrolled face for user_detail_id {user_detail_id}")
+            logger.info("Successfully enrolled face for user_detail_id %s", user_detail_id)
             return {
                 'success': True,
                 'message': f'Face enrolled successfully for user {user_detail_id}',
-                'face_info': {
-                    'bbox': face_info['bbox'],
-                    'landmarks': face_info['landmarks'],
-                    'confidence': face_info['confidence'],
-                    'age': face_info['age'],
-                    'gender': face_info['gender']
-                },
+                'face_info': record['face_info'],
                 'processing_time_ms': int(processing_time)
             }
             
         except Exception as e:
-            processing_time = (datetime.now() - start_time).total_seconds() * 1000
             error_msg = f"Error enrolling face: {str(e)}"
             logger.error(error_msg)
-            
-            # Log failed enrollment
-            if self.supabase_service:
-                self.supabase_service.log_face_enrollment(
-                    user_detail_id, user_id,
-                    {
-                        'enrollment_status': 'failed',
-                        'face_count_detected': 0,
-                        'error_message': error_msg,
-                        'image_source': 'api',
-                        'processing_time_ms': int(processing_time)
-                    }
-                )
-            
-            return {
-                'success': False,
-                'message': error_msg
-            }
+            return self._enrollment_failed(user_detail_id, user_id, error_msg, start_time)
     
     def remove_face(self, user_id: str) -> bool:
         """Remove a face from the database"""
         try:
             if user_id in self.face_database:
                 del self.face_database[user_id]
-                self.save_face_database()
+                self._gallery_dirty = True
+                self._append_to_journal(user_id)
                 logger.info(f"Removed face for user {user_id}")
                 return True
             else:
@@ -463,7 +1426,7 @@ class ArcFaceService:
             
             logger.info(f"Starting face enrollment for {len(users_to_enroll)} users")
             
-            for user in users_to_enroll:
+            for user, downloaded, face_info in self._iter_user_face_infos(users_to_enroll):
                 try:
                     user_detail_id = user['id']
                     user_id = user['userId']
@@ -478,9 +1441,8 @@ class ArcFaceService:
                         })
                         continue
                     
-                    # Download and process the image
-                    image = self.download_image(face_url)
-                    if image is None:
+                    # Image download and face extraction ran batched in _iter_user_face_infos
+                    if not downloaded:
                         failed_count += 1
                         results.append({
                             'user_detail_id': user_detail_id,
@@ -489,8 +1451,6 @@ class ArcFaceService:
                         })
                         continue
                     
-                    # Extract face information
-                    face_info = self.extract_face_info(image)
                     if face_info is None:
                         failed_count += 1
                         results.append({
@@ -513,23 +1473,12 @@ class ArcFaceService:
                         continue
                     
                     # Store in local database
-                    self.face_database[user_detail_id] = {
-                        'embedding': face_info['embedding'],
-                        'user_data': user,
-                        'face_info': {
-                            'bbox': face_info['bbox'],
-                            'landmarks': face_info['landmarks'],
-                            'confidence': face_info['confidence'],
-                            'age': face_info['age'],
-                            'gender': face_info['gender']
-                        },
-                        'enrolled_at': datetime.now().isoformat(),
-                        'user_detail_id': user_detail_id,
-                        'user_id': user_id
-                    }
+                    self.face_database[user_detail_id] = self._face_record(
+                        face_info, user, datetime.now().isoformat(), user_detail_id=user_detail_id, user_id=user_id)
+                    self._gallery_dirty = True
                     
                     # Save to database
-                    embedding_result = self.supabase_service.save_face_embedding(
+                    self.supabase_service.save_face_embedding(
                         user_detail_id, user_id,
                         {
                             'embedding': face_info['embedding'],
@@ -540,7 +1489,7 @@ class ArcFaceService:
                         }
                     )
                     
-                    landmarks_result = self.supabase_service.save_face_landmarks(
+                    self.supabase_service.save_face_landmarks(
                         user_detail_id, user_id,
                         {
                             'landmarks': face_info['landmarks'],
@@ -563,14 +1512,15 @@ class ArcFaceService:
                     )
                     
                     enrolled_count += 1
+                    user_name = f"{user.get('firstName', '')} {user.get('lastName', '')}"
                     results.append({
                         'user_detail_id': user_detail_id,
                         'status': 'success',
                         'confidence': face_info['confidence'],
-                        'message': f"Successfully enrolled {user.get('firstName', '')} {user.get('lastName', '')}"
+                        'message': f"Successfully enrolled {user_name}"
                     })
                     
-                    logger.info(f"Successfully enrolled face for {user.get('firstName', '')} {user.get('lastName', '')} (ID: {user_detail_id})")
+                    logger.info("Successfully enrolled face for %s (ID: %s)", user_name, user_detail_id)
                     
                 except Exception as e:
                     failed_count += 1
@@ -629,7 +1579,7 @@ class ArcFaceService:
             
             for embedding_data in embeddings:
                 user_detail_id = embedding_data['user_detail_id']
-                embedding_array = np.array(embedding_data['embedding'], dtype=np.float32)
+                embedding_array = normalize_embedding(embedding_data['embedding'])
                 
                 self.face_database[user_detail_id] = {
                     'embedding': embedding_array,
@@ -637,6 +1587,7 @@ class ArcFaceService:
                     'confidence': embedding_data['confidence']
                 }
             
+            self._gallery_dirty = True
             logger.info(f"Loaded {len(self.face_database)} face embeddings from database")
             return True
             
@@ -664,7 +1615,7 @@ class ArcFaceService:
                 'errors': []
             }
             
-            for user in users:
+            for user, downloaded, face_info in self._iter_user_face_infos(users):
                 face_url = user.get('faceScannedUrl')
                 if not face_url or not face_url.strip():
                     continue
@@ -672,37 +1623,23 @@ class ArcFaceService:
                 results['processed'] += 1
                 user_id = user['id']
                 
-                logger.info(f"Processing face for {user.get('firstName', '')} {user.get('lastName', '')} - {user_id}")
+                logger.info("Processing face for %s %s - %s", user.get('firstName', ''), user.get('lastName', ''), user_id)
                 
                 try:
-                    # Download and process the face image
-                    image = self.download_image(face_url)
-                    if image is None:
+                    # Image download and face extraction ran batched in _iter_user_face_infos
+                    if not downloaded:
                         results['failed'] += 1
                         results['errors'].append(f"Could not download image for user {user_id}")
                         continue
                     
-                    # Extract face information
-                    face_info = self.extract_face_info(image)
                     if face_info is None:
                         results['failed'] += 1
                         results['errors'].append(f"No face detected for user {user_id}")
                         continue
                     
-                    # Store in local face database (pickle file)
-                    self.face_database[user_id] = {
-                        'embedding': face_info['embedding'],
-                        'user_data': user,
-                        'face_info': {
-                            'bbox': face_info['bbox'],
-                            'landmarks': face_info['landmarks'],
-                            'confidence': face_info['confidence'],
-                            'age': face_info['age'],
-                            'gender': face_info['gender']
-                        },
-                        'enrolled_at': datetime.now().isoformat(),
-                        'source': 'database_scan'
-                    }
+                    # Store in local face database
+                    self.face_database[user_id] = self._face_record(face_info, user, datetime.now().isoformat(), source='database_scan')
+                    self._gallery_dirty = True
                     
                     # Optionally save to database
                     if save_to_db:
@@ -721,7 +1658,7 @@ class ArcFaceService:
                         supabase_service.save_face_embedding(user_id, embedding_data)
                     
                     results['enrolled'] += 1
-                    logger.info(f"Successfully enrolled face for user {user_id}")
+                    logger.info("Successfully enrolled face for user %s", user_id)
                     
                 except Exception as user_error:
                     results['failed'] += 1
@@ -1,24 +1,37 @@
+import os
+
+# Keep NumPy's BLAS single-threaded: the server already runs requests on several
+# threads, and per-call BLAS thread pools on top of that only oversubscribe the CPU.
+# This has to happen before numpy is first imported (pandas/cv2 below import it).
+for _blas_threads_var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+    os.environ.setdefault(_blas_threads_var, '1')
+
 from flask import Flask, request, jsonify, send_file
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from dotenv import load_dotenv
 from io import BytesIO
-from PIL import Image
 from datetime import date, datetime
+from collections import Counter
+from urllib.parse import urlparse
 import logging
+import json
 import threading
 import time
-import os
 import sys
 import pandas as pd
-import base64
-import cv2
-import numpy as np
+from openpyxl.utils import get_column_letter
+
+try:
+    import orjson  # Optional faster parser for large base64 request bodies
+except ImportError:
+    orjson = None
 
 # Add the src directory to Python path for imports
 sys.path.append(os.path.dirname(__file__))
 
-from arcface_service import ArcFaceService
-from supabase_service import SupabaseService
+from arcface_service import ArcFaceService, decode_base64_image
+from supabase_service import get_supabase_service
 
 # Load environment variables
 load_dotenv()
@@ -27,10 +40,41 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Fields a client needs to enroll a pending user (/face-status?needs_enrollment=1);
+# enrollment_status keeps include_faces_count's status_counts meaningful
+ENROLLMENT_CANDIDATE_COLUMNS = 'user_detail_id, user_id, "firstName", "lastName", "faceScannedUrl", enrollment_status'
+
+# Largest k accepted by /recognize-top-k
+MAX_TOP_K = 20
+
+class NumpyJSONProvider(DefaultJSONProvider):
+    """JSON provider that also serializes NumPy arrays and scalars (face bboxes, landmarks)"""
+    
+    @staticmethod
+    def default(o):
+        if hasattr(o, 'tolist'):
+            return o.tolist()
+        return DefaultJSONProvider.default(o)
+
+def is_allowed_image_url(image_url) -> bool:
+    """Whether /enroll may fetch image_url server-side
+    
+    Only Supabase Storage paths and http(s) URLs on the configured SUPABASE_URL
+    host are allowed, so the endpoint cannot be used to reach other hosts.
+    """
+    if not isinstance(image_url, str) or not image_url.strip():
+        return False
+    parsed = urlparse(image_url)
+    if not parsed.scheme and not parsed.netloc:
+        return True  # Storage path inside the project's bucket
+    allowed_host = urlparse(os.getenv('SUPABASE_URL', '')).hostname
+    return parsed.scheme in ('http', 'https') and allowed_host is not None and parsed.hostname == allowed_host
+
 class FaceRecognitionApp:
     def __init__(self):
         # Initialize Flask app
         self.app = Flask(__name__)
+        self.app.json = NumpyJSONProvider(self.app)
         
         # Configure CORS to allow all origins and bypass CORS restrictions
         CORS(self.app, 
@@ -41,7 +85,7 @@ class FaceRecognitionApp:
         
         # Initialize services
         self.arcface_service = ArcFaceService()
-        self.supabase_service = SupabaseService()
+        self.supabase_service = get_supabase_service()
         
         # Inject supabase service into arcface service
         self.arcface_service.set_supabase_service(self.supabase_service)
@@ -52,8 +96,10 @@ class FaceRecognitionApp:
         # Also try to load embeddings from database
         self.arcface_service.load_embeddings_from_database()
         
-        # Recognition cooldown tracking
+        # Recognition cooldown tracking (time.monotonic() per user, so wall-clock
+        # adjustments cannot skip or extend a cooldown)
         self.last_recognition = {}
+        self._last_recognition_lock = threading.Lock()
         self.RECOGNITION_COOLDOWN = 3  # seconds between recognitions for same user
         
         # Auto-reload configuration
@@ -106,6 +152,7 @@ class FaceRecognitionApp:
                     'health': '/health',
                     'recognize': '/recognize',
                     'enroll': '/enroll',
+                    'enroll-batch': '/enroll-batch',
                     'extract-landmarks': '/extract-landmarks',
                     'faces': '/faces',
                     'sync-faces-from-db': '/sync-faces-from-db',
@@ -210,6 +257,7 @@ class FaceRecognitionApp:
                 self.arcface_service.load_face_database()
                 
                 # Get all users from Supabase
+                self.supabase_service.invalidate_users_cache()
                 users = self.supabase_service.get_all_users_with_profiles()
                 
                 if not users:
@@ -222,7 +270,7 @@ class FaceRecognitionApp:
                 success_count = self.arcface_service.register_multiple_faces(users)
                 
                 # Update auto-reload manager
-                self.auto_reload_manager.known_user_count = len(users)
+                self.auto_reload_manager.known_user_count = self.supabase_service.get_user_count() or 0
                 
                 return jsonify({
                     'success': True,
@@ -242,9 +290,14 @@ class FaceRecognitionApp:
         def recognize_face():
             """Recognize face from uploaded image and mark attendance"""
             try:
-                data = request.get_json()
+                # Parse the (often ~1MB) body once, without keeping a cached copy on the request
+                body = request.get_data(cache=False)
+                try:
+                    data = orjson.loads(body) if orjson is not None else json.loads(body)
+                except ValueError:
+                    data = None
                 
-                if not data or 'image' not in data:
+                if not isinstance(data, dict) or 'image' not in data:
                     return jsonify({
                         'success': False,
                         'message': 'No image data provided'
@@ -260,20 +313,21 @@ class FaceRecognitionApp:
                     user_data = result['user_data']
                     user_id = user_data['id']
                     
-                    # Check cooldown to prevent spam recognition
-                    current_time = time.time()
-                    if user_id in self.last_recognition:
-                        time_diff = current_time - self.last_recognition[user_id]
-                        if time_diff < self.RECOGNITION_COOLDOWN:
-                            return jsonify({
-                                'success': True,
-                                'recognized': True,
-                                'message': f'Please wait {self.RECOGNITION_COOLDOWN - int(time_diff)} seconds before next recognition',
-                                'cooldown_remaining': self.RECOGNITION_COOLDOWN - time_diff
-                            })
+                    # Check cooldown to prevent spam recognition. Check and update happen
+                    # under one lock so concurrent frames of the same user mark attendance once
+                    current_time = time.monotonic()
+                    with self._last_recognition_lock:
+                        time_diff = current_time - self.last_recognition.get(user_id, float('-inf'))
+                        if time_diff >= self.RECOGNITION_COOLDOWN:
+                            self.last_recognition[user_id] = current_time
                     
-                    # Update last recognition time
-                    self.last_recognition[user_id] = current_time
+                    if time_diff < self.RECOGNITION_COOLDOWN:
+                        return jsonify({
+                            'success': True,
+                            'recognized': True,
+                            'message': f'Please wait {self.RECOGNITION_COOLDOWN - int(time_diff)} seconds before next recognition',
+                            'cooldown_remaining': self.RECOGNITION_COOLDOWN - time_diff
+                        })
                     
                     # Mark attendance
                     attendance_result = self.supabase_service.mark_attendance(user_id, user_data)
@@ -327,12 +381,51 @@ class FaceRecognitionApp:
                     })
                     
             except Exception as e:
-                logger.error(f"Error recognizing face: {e}")
+                logger.error("Error recognizing face: %s", e)
                 return jsonify({
                     'success': False,
                     'message': f'Error recognizing face: {str(e)}'
                 }), 500
 
+        @self.app.route('/recognize-top-k', methods=['POST'])
+        def recognize_top_k():
+            """Return the k most similar registered faces above the threshold
+            
+            JSON body: {"image": <base64>, "k": 5}. Only ranks candidates (e.g. for
+            manual confirmation); attendance is not marked.
+            """
+            try:
+                data = request.get_json()
+                
+                if not isinstance(data, dict) or 'image' not in data:
+                    return jsonify({
+                        'success': False,
+                        'message': 'No image data provided'
+                    }), 400
+                
+                k = data.get('k', 5)
+                if not isinstance(k, int) or isinstance(k, bool) or not 1 <= k <= MAX_TOP_K:
+                    return jsonify({
+                        'success': False,
+                        'message': f'k must be an integer between 1 and {MAX_TOP_K}'
+                    }), 400
+                
+                image = self.arcface_service.decode_image_bytes(decode_base64_image(data['image']))
+                matches = self.arcface_service.recognize_top_k(image, k)
+                
+                return jsonify({
+                    'success': True,
+                    'recognized': bool(matches),
+                    'matches': matches
+                })
+                
+            except Exception as e:
+                logger.error("Error ranking faces: %s", e)
+                return jsonify({
+                    'success': False,
+                    'message': f'Error ranking faces: {str(e)}'
+                }), 500
+
         @self.app.route('/attendance', methods=['GET'])
         def get_attendance():
             """Get all attendance records for today"""
@@ -368,7 +461,8 @@ class FaceRecognitionApp:
                     'total_users': total_users,
                     'total_faces': stats['total_faces'],
                     'users_with_faces': stats['total_faces'],
-                    'threshold': stats['threshold']
+                    'threshold': stats['threshold'],
+                    'recognition_cache': stats['recognition_cache']
                 }
                 
                 return jsonify({
@@ -420,6 +514,7 @@ class FaceRecognitionApp:
             """Refresh the face database with latest user data"""
             try:
                 # Get updated users from Supabase
+                self.supabase_service.invalidate_users_cache()
                 users = self.supabase_service.get_all_users_with_profiles()
                 
                 if not users:
@@ -428,9 +523,9 @@ class FaceRecognitionApp:
                         'message': 'No users found in database'
                     }), 404
                 
-                # Clear existing database and re-register faces
+                # Clear existing database and re-register faces from freshly downloaded images
                 self.arcface_service.face_database.clear()
-                success_count = self.arcface_service.register_multiple_faces(users)
+                success_count = self.arcface_service.register_multiple_faces(users, use_image_cache=False)
                 
                 return jsonify({
                     'success': True,
@@ -467,23 +562,39 @@ class FaceRecognitionApp:
 
         @self.app.route('/enroll', methods=['POST'])
         def enroll_face():
-            """Enroll a new face for recognition"""
+            """Enroll a new face for recognition
+            
+            Accepts either a JSON body with a base64 'image' (or an 'image_url' the
+            server fetches itself), or multipart/form-data with the raw image bytes
+            in an 'image' file field (no base64 overhead).
+            """
             try:
+                if request.files:
+                    return enroll_face_multipart()
+                
                 data = request.get_json()
                 
-                if not data or 'image' not in data or 'user_detail_id' not in data or 'user_id' not in data:
+                if not data or ('image' not in data and 'image_url' not in data) or 'user_detail_id' not in data or 'user_id' not in data:
                     return jsonify({
                         'success': False,
-                        'message': 'Missing required fields: image, user_detail_id, and user_id'
+                        'message': 'Missing required fields: image (or image_url), user_detail_id, and user_id'
                     }), 400
                 
                 user_detail_id = data['user_detail_id']
                 user_id = data['user_id']
-                base64_image = data['image']
                 user_data = data.get('user_data', {})
                 
+                if 'image' not in data and not is_allowed_image_url(data['image_url']):
+                    return jsonify({
+                        'success': False,
+                        'message': 'image_url must be a Supabase Storage path or URL'
+                    }), 400
+                
                 # Enroll the face
-                result = self.arcface_service.enroll_face_from_base64(user_detail_id, user_id, base64_image, user_data)
+                if 'image' in data:
+                    result = self.arcface_service.enroll_face_from_base64(user_detail_id, user_id, data['image'], user_data)
+                else:
+                    result = self.arcface_service.enroll_face_from_url(user_detail_id, user_id, data['image_url'], user_data)
                 
                 if result['success']:
                     return jsonify(result), 200
@@ -497,6 +608,116 @@ class FaceRecognitionApp:
                     'message': f'Error enrolling face: {str(e)}'
                 }), 500
 
+        def enroll_face_multipart():
+            """Enroll a face posted as multipart/form-data"""
+            image_file = request.files.get('image')
+            user_detail_id = request.form.get('user_detail_id')
+            user_id = request.form.get('user_id')
+            
+            if image_file is None or not user_detail_id or not user_id:
+                return jsonify({
+                    'success': False,
+                    'message': 'Missing required fields: image, user_detail_id, and user_id'
+                }), 400
+            
+            # Optional user data is sent as a JSON-encoded form field
+            try:
+                user_data = json.loads(request.form['user_data']) if request.form.get('user_data') else {}
+            except ValueError:
+                user_data = None
+            if not isinstance(user_data, dict):
+                return jsonify({
+                    'success': False,
+                    'message': 'user_data must be a JSON object'
+                }), 400
+            
+            result = self.arcface_service.enroll_face_from_bytes(user_detail_id, user_id, image_file.read(), user_data)
+            
+            if result['success']:
+                return jsonify(result), 200
+            else:
+                return jsonify(result), 400
+
+        @self.app.route('/enroll-batch', methods=['POST'])
+        def enroll_faces_batch():
+            """Enroll several faces in one request
+            
+            multipart/form-data: a 'meta' field holding a JSON list of
+            {user_detail_id, user_id, user_data} objects and files image_0..image_N.
+            JSON: {"faces": [{image, user_detail_id, user_id, user_data}, ...]} with base64 images.
+            """
+            try:
+                enrollments = []
+                
+                if request.files:
+                    try:
+                        meta = json.loads(request.form.get('meta', '[]'))
+                    except ValueError:
+                        meta = None
+                    if not isinstance(meta, list) or not all(isinstance(entry, dict) for entry in meta):
+                        return jsonify({
+                            'success': False,
+                            'message': 'meta must be a JSON list of objects'
+                        }), 400
+                    for index, entry in enumerate(meta):
+                        image_file = request.files.get(f'image_{index}')
+                        if image_file is None or 'user_detail_id' not in entry or 'user_id' not in entry:
+                            return jsonify({
+                                'success': False,
+                                'message': f'Entry {index} is missing image_{index}, user_detail_id or user_id'
+                            }), 400
+                        enrollments.append({
+                            'user_detail_id': entry['user_detail_id'],
+                            'user_id': entry['user_id'],
+                            'user_data': entry.get('user_data', {}),
+                            'image_data': image_file.read()
+                        })
+                else:
+                    data = request.get_json() or {}
+                    faces = data.get('faces', []) if isinstance(data, dict) else None
+                    if not isinstance(faces, list) or not all(isinstance(entry, dict) for entry in faces):
+                        return jsonify({
+                            'success': False,
+                            'message': 'faces must be a JSON list of objects'
+                        }), 400
+                    for index, entry in enumerate(faces):
+                        if 'image' not in entry or 'user_detail_id' not in entry or 'user_id' not in entry:
+                            return jsonify({
+                                'success': False,
+                                'message': f'Entry {index} is missing image, user_detail_id or user_id'
+                            }), 400
+                        # Decoded per entry by the service, so a bad image only fails its own entry
+                        enrollments.append({
+                            'user_detail_id': entry['user_detail_id'],
+                            'user_id': entry['user_id'],
+                            'user_data': entry.get('user_data', {}),
+                            'image': entry['image']
+                        })
+                
+                if not enrollments:
+                    return jsonify({
+                        'success': False,
+                        'message': 'No faces provided'
+                    }), 400
+                
+                results = self.arcface_service.enroll_faces_batch(enrollments)
+                enrolled_count = sum(1 for result in results if result['success'])
+                
+                return jsonify({
+                    'success': True,
+                    'message': f'Batch enrollment completed. Enrolled: {enrolled_count}, Failed: {len(results) - enrolled_count}',
+                    'enrolled_count': enrolled_count,
+                    'failed_count': len(results) - enrolled_count,
+                    'results': results
+                })
+                
+            except Exception as e:
+                logger.error(f"Error enrolling face batch: {e}")
+                return jsonify({
+                    'success': False,
+                    'message': f'Error enrolling face batch: {str(e)}'
+                }), 500
+
         @self.app.route('/extract-landmarks', methods=['POST'])
         def extract_landmarks():
             """Extract facial landmarks and information from image"""
@@ -512,10 +733,8 @@ class FaceRecognitionApp:
                 base64_image = data['image']
                 
                 # Decode and process image
-                import base64
-                image_data = base64.b64decode(base64_image.split(',')[1] if ',' in base64_image else base64_image)
-                image = Image.open(BytesIO(image_data))
-                opencv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+                image_data = decode_base64_image(base64_image)
+                opencv_image = self.arcface_service.decode_image_bytes(image_data)
                 
                 # Extract face info
                 face_info = self.arcface_service.extract_face_info(opencv_image)
@@ -608,15 +827,58 @@ class FaceRecognitionApp:
 
         @self.app.route('/face-status', methods=['GET'])
         def get_face_enrollment_status():
-            """Get face enrollment status for all users"""
+            """Get face enrollment status for all users
+            
+            Optional query parameters:
+            - has_face=1: only users that have a face image
+            - status=pending|enrolled|no_image: only users with that enrollment status
+            - needs_enrollment=1: only users with a face image that are not yet
+              enrolled, returning just the fields needed to enroll them
+            - page_size=N&cursor=<user_detail_id>: page through results; the response
+              carries next_cursor while more pages remain
+            - include_faces_count=1: also return per-status counts and the number of
+              faces loaded for recognition, so one call covers a post-sync check
+            """
             try:
-                status_data = self.supabase_service.get_user_face_status()
+                has_face = request.args.get('has_face', '').lower() in ('1', 'true', 'yes')
+                needs_enrollment = request.args.get('needs_enrollment', '').lower() in ('1', 'true', 'yes')
+                include_faces_count = request.args.get('include_faces_count', '').lower() in ('1', 'true', 'yes')
+                status = request.args.get('status')
+                page_size = request.args.get('page_size', type=int)
+                if 'page_size' in request.args and (page_size is None or page_size <= 0):
+                    return jsonify({
+                        'success': False,
+                        'message': 'page_size must be a positive integer'
+                    }), 400
+                cursor = request.args.get('cursor')
                 
-                return jsonify({
+                status_data = self.supabase_service.get_user_face_status(
+                    has_face=has_face,
+                    status=status,
+                    page_size=page_size,
+                    cursor=cursor,
+                    needs_enrollment=needs_enrollment,
+                    columns=ENROLLMENT_CANDIDATE_COLUMNS if needs_enrollment else '*'
+                )
+                
+                response_data = {
                     'success': True,
                     'data': status_data,
                     'total_users': len(status_data)
-                })
+                }
+                
+                if page_size:
+                    last_page = len(status_data) < page_size
+                    response_data['next_cursor'] = None if last_page else status_data[-1]['user_detail_id']
+                
+                if include_faces_count:
+                    response_data['status_counts'] = dict(Counter(row.get('enrollment_status') for row in status_data))
+                    response_data['enrolled_faces'] = len(self.arcface_service.face_database)
+                
+                # ETag lets repeat callers revalidate with If-None-Match and get a 304
+                response = jsonify(response_data)
+                response.add_etag()
+                return response.make_conditional(request)
                 
             except Exception as e:
                 logger.error(f"Error getting face status: {e}")
@@ -709,7 +971,7 @@ class FaceRecognitionApp:
 
         @self.app.route('/attendance/export', methods=['GET'])
         def export_attendance():
-            """Export today's attendance to Excel"""
+            """Export today's attendance to Excel (or CSV with ?format=csv)"""
             try:
                 # Get today's attendance
                 attendance_records = self.supabase_service.get_today_attendance()
@@ -746,40 +1008,46 @@ class FaceRecognitionApp:
                 if 'Time In' in df_export.columns:
                     df_export['Time In'] = pd.to_datetime(df_export['Time In']).dt.strftime('%I:%M:%S %p')
                 
+                today_str = date.today().strftime('%Y-%m-%d')
+                
+                # CSV skips openpyxl's per-cell object model entirely for large days
+                if request.args.get('format') == 'csv':
+                    return send_file(
+                        BytesIO(df_export.to_csv(index=False).encode('utf-8')),
+                        mimetype='text/csv',
+                        as_attachment=True,
+                        download_name=f'BEACON_2025_Attendance_{today_str}.csv',
+                        conditional=True,
+                        max_age=0
+                    )
+                
                 # Create Excel file in memory
                 output = BytesIO()
                 
                 with pd.ExcelWriter(output, engine='openpyxl') as writer:
                     df_export.to_excel(writer, sheet_name='Daily Attendance', index=False)
                     
-                    # Format the worksheet
-                    workbook = writer.book
+                    # Auto-adjust column widths from the DataFrame (header or longest value)
+                    # instead of walking every worksheet cell
                     worksheet = writer.sheets['Daily Attendance']
-                    
-                    # Auto-adjust column widths
-                    for column in worksheet.columns:
-                        max_length = 0
-                        column_letter = column[0].column_letter
-                        for cell in column:
-                            try:
-                                if len(str(cell.value)) > max_length:
-                                    max_length = len(str(cell.value))
-                            except:
-                                pass
-                        adjusted_width = (max_length + 2)
-                        worksheet.column_dimensions[column_letter].width = adjusted_width
+                    for index, column in enumerate(df_export.columns, start=1):
+                        max_length = max(len(str(column)), int(df_export[column].astype(str).str.len().max()))
+                        worksheet.column_dimensions[get_column_letter(index)].width = max_length + 2
                 
                 output.seek(0)
                 
                 # Generate filename
-                today_str = date.today().strftime('%Y-%m-%d')
                 filename = f'BEACON_2025_Attendance_{today_str}.xlsx'
                 
+                # conditional=True sends Content-Length and honours Range requests;
+                # the in-memory buffer is handed to the server's wsgi.file_wrapper
                 return send_file(
                     output,
                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
                     as_attachment=True,
-                    download_name=filename
+                    download_name=filename,
+                    conditional=True,
+                    max_age=0
                 )
                 
             except Exception as e:
@@ -841,7 +1109,7 @@ class FaceRecognitionApp:
                 users = self.supabase_service.get_all_users_with_profiles()
                 if users:
                     success_count = self.arcface_service.register_multiple_faces(users)
-                    self.auto_reload_manager.known_user_count = len(users)
+                    self.auto_reload_manager.known_user_count = self.supabase_service.get_user_count() or 0
                     print(f"✅ Registered {success_count} faces from Supabase")
                     logger.info(f"Registered {success_count} faces from Supabase")
             
@@ -897,20 +1165,30 @@ class AutoReloadManager:
         """Background monitoring loop"""
         while self.auto_reload_enabled:
             try:
-                # Check for new users
-                users = self.supabase_service.get_all_users_with_profiles()
-                current_count = len(users) if users else 0
+                # Check for new users with a count-only query; the full user list is
+                # only fetched when the count grows
+                current_count = self.supabase_service.get_user_count() or 0
                 
                 if self.known_user_count == 0:
                     # First time initialization
                     self.known_user_count = current_count
                     logger.info(f"📊 Initial user count: {current_count}")
                 elif current_count > self.known_user_count:
-                    # New users detected, reload face database
+                    # New users detected, register only the faces not loaded yet
                     logger.info(f"🆕 New users detected! Count changed from {self.known_user_count} to {current_count}")
-                    success_count = self.arcface_service.register_multiple_faces(users)
+                    self.supabase_service.invalidate_users_cache()
+                    users = self.supabase_service.get_all_users_with_profiles() or []
+                    # Faces are keyed by user_detail_id (enrolled or loaded from the database)
+                    # or by userId (registered from profiles), so match either
+                    known_ids = set()
+                    for key, entry in list(self.arcface_service.face_database.items()):
+                        known_ids.add(key)
+                        known_ids.add((entry.get('user_data') or {}).get('user_id'))
+                    new_users = [user for user in users
+                                 if user['id'] not in known_ids and user.get('detail_id') not in known_ids]
+                    success_count = self.arcface_service.register_multiple_faces(new_users)
                     self.known_user_count = current_count
-                    logger.info(f"✅ Reloaded face database with {success_count} faces")
+                    logger.info("✅ Registered %d new faces", success_count)
                 
                 time.sleep(self.check_interval)
                 
@@ -0,0 +1,33 @@
+"""
+Numba kernels for matching a query embedding against small face galleries
+"""
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Below this many faces a fused loop beats the per-call overhead of BLAS/SimSIMD
+# (measured crossover against single-threaded OpenBLAS GEMV is ~128-192 faces)
+SMALL_GALLERY_SIZE = 128
+
+if njit is not None:
+    @njit(fastmath=True, cache=True)
+    def best_match(gallery, query):
+        """Return (index, similarity) of the gallery row with the highest dot product"""
+        best_index = -1
+        best_similarity = -np.inf
+        for i in range(gallery.shape[0]):
+            # A float32 accumulator keeps the loop in 8-wide float32 FMAs; a Python
+            # float literal here would widen every product to float64
+            similarity = np.float32(0.0)
+            for k in range(gallery.shape[1]):
+                similarity += gallery[i, k] * query[k]
+            if similarity > best_similarity:
+                best_similarity = similarity
+                best_index = i
+        return best_index, best_similarity
+else:
+    best_match = None
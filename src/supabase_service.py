@@ -1,8 +1,13 @@
 from supabase import create_client, Client
 import os
 from typing import List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from datetime import date, datetime, timezone, timedelta
+import functools
+import threading
+import base64
+import json
+from datetime import datetime, timezone, timedelta
 import time
 from dotenv import load_dotenv
 
@@ -12,9 +17,29 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Process-wide Supabase client, shared so every SupabaseService reuses one connection pool
+_CLIENT: Optional[Client] = None
+
+# Seconds a get_all_users_with_profiles() result is reused (polled /stats, reloads)
+USERS_CACHE_TTL = float(os.getenv('USERS_CACHE_TTL', 5))
+
+@functools.lru_cache(maxsize=4)
+def _decode_jwt_claims(token: str) -> Dict:
+    """Read the (unverified) claims of a JWT by decoding its payload segment"""
+    payload_b64 = token.split('.')[1]
+    payload_b64 += '=' * (-len(payload_b64) % 4)
+    return json.loads(base64.urlsafe_b64decode(payload_b64))
+
+def _to_list(value):
+    """Convert NumPy arrays to plain lists for JSON columns; other values pass through"""
+    return value.tolist() if hasattr(value, 'tolist') else value
+
 class SupabaseService:
     def __init__(self):
         self.supabase: Client = None
+        # (monotonic fetch time, users) for get_all_users_with_profiles
+        self._users_cache = (0.0, None)
+        self._users_cache_lock = threading.Lock()
         self.initialize_client()
     
     def initialize_client(self):
@@ -33,8 +58,7 @@ class SupabaseService:
             
             # Determine key type based on JWT payload
             try:
-                import jwt
-                decoded = jwt.decode(key, options={"verify_signature": False})
+                decoded = _decode_jwt_claims(key)
                 role = decoded.get('role', 'unknown')
                 logger.info(f"Supabase key role: {role}")
                 
@@ -47,8 +71,13 @@ class SupabaseService:
             except Exception as jwt_error:
                 logger.warning(f"Could not decode JWT to check role: {jwt_error}")
             
-            self.supabase = create_client(url, key)
-            logger.info("Supabase client initialized successfully")
+            global _CLIENT
+            if _CLIENT is None:
+                _CLIENT = create_client(url, key)
+                logger.info("Supabase client initialized successfully")
+            else:
+                logger.info("Reusing existing Supabase client")
+            self.supabase = _CLIENT
             
         except Exception as e:
             logger.error(f"Error initializing Supabase client: {e}")
@@ -168,25 +197,26 @@ class SupabaseService:
                 results['table_access']['users_accessible'] = False
                 results['error_details'] = str(table_error)
             
-            # Test profiles table if users table works
-            if results['table_access'].get('users_accessible'):
-                try:
-                    response = self.supabase.table('profiles').select('count', count='exact').limit(0).execute()
-                    results['table_access']['profiles_accessible'] = True
-                    results['table_access']['profiles_count'] = response.count
-                except Exception as profiles_error:
-                    results['table_access']['profiles_accessible'] = False
-                    results['table_access']['profiles_error'] = str(profiles_error)
-            
-            # Test attendance table
+            # Test profiles and attendance tables if users table works.
+            # The probes are independent round-trips, so issue them concurrently.
             if results['table_access'].get('users_accessible'):
-                try:
-                    response = self.supabase.table('attendance').select('count', count='exact').limit(0).execute()
-                    results['table_access']['attendance_accessible'] = True
-                    results['table_access']['attendance_count'] = response.count
-                except Exception as attendance_error:
-                    results['table_access']['attendance_accessible'] = False
-                    results['table_access']['attendance_error'] = str(attendance_error)
+                def probe_table(table_name):
+                    try:
+                        response = self.supabase.table(table_name).select('count', count='exact').limit(0).execute()
+                        return table_name, response.count, None
+                    except Exception as probe_error:
+                        return table_name, None, probe_error
+
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    probes = list(executor.map(probe_table, ['profiles', 'attendance']))
+
+                for table_name, count, probe_error in probes:
+                    if probe_error is None:
+                        results['table_access'][f'{table_name}_accessible'] = True
+                        results['table_access'][f'{table_name}_count'] = count
+                    else:
+                        results['table_access'][f'{table_name}_accessible'] = False
+                        results['table_access'][f'{table_name}_error'] = str(probe_error)
         
         except Exception as e:
             results['connection_status'] = 'ERROR'
@@ -194,15 +224,40 @@ class SupabaseService:
         
         return results
     
+    def fetch_all_rows(self, table_name: str, columns: str = '*', page_size: int = 1000, key: str = 'id') -> List[Dict]:
+        """Fetch every row of a table in fixed-size pages, selecting only the given columns
+        
+        Pages are ordered by key and read with keyset pagination (key > last key seen),
+        so no row is skipped or repeated between pages; key must be one of the columns.
+        """
+        rows = []
+        last_key = None
+        
+        while True:
+            query = self.supabase.table(table_name).select(columns)
+            if last_key is not None:
+                query = query.gt(key, last_key)
+            response = query.order(key).limit(page_size).execute()
+            page = response.data or []
+            rows.extend(page)
+            
+            if len(page) < page_size:
+                return rows
+            last_key = page[-1][key]
+    
     def get_all_users_with_details(self) -> Optional[List[Dict]]:
         """Get all users with their detailed profile information from user_details table"""
         try:
-            # Query users with their details
-            response = self.supabase.table('user_details').select('*').execute()
-            
-            if response.data:
+            # Query users with their details (only the columns mapped below)
+            user_details = self.fetch_all_rows(
+                'user_details',
+                'id, "userId", "firstName", "lastName", "middleName", suffix, "preferredName", '
+                '"faceScannedUrl", position, gender, "ageBracket", nationality'
+            )
+            
+            if user_details:
                 users = []
-                for user_detail in response.data:
+                for user_detail in user_details:
                     user_data = {
                         'id': user_detail.get('userId', ''),  # Use userId from user_details as main ID
                         'detail_id': user_detail.get('id', ''),
@@ -275,8 +330,9 @@ class SupabaseService:
             landmark_data = {
                 'user_detail_id': user_detail_id,
                 'user_id': user_id,
-                'landmarks': landmarks_data.get('landmarks', []),
-                'bbox': landmarks_data.get('bbox', []),
+                # Face info keeps bbox/landmarks as NumPy arrays until this JSON boundary
+                'landmarks': _to_list(landmarks_data.get('landmarks', [])),
+                'bbox': _to_list(landmarks_data.get('bbox', [])),
                 'face_area': landmarks_data.get('face_area'),
                 'face_angle': landmarks_data.get('face_angle'),
                 'age': landmarks_data.get('age'),
@@ -373,7 +429,7 @@ class SupabaseService:
                 # Fallback to manual query if RPC doesn't exist
                 response = self.supabase.table('user_details').select(
                     'id, "userId", "firstName", "lastName", "middleName", "faceScannedUrl"'
-                ).neq('faceScannedUrl', '').is_('faceScannedUrl', 'not.null').execute()
+                ).neq('faceScannedUrl', '').execute()
                 
                 if response.data:
                     # Filter out already enrolled users
@@ -411,11 +467,35 @@ class SupabaseService:
             logger.error(f"Error getting face embeddings: {e}")
             return []
     
-    def get_user_face_status(self) -> List[Dict]:
-        """Get face enrollment status for all users"""
+    def get_user_face_status(self, has_face: bool = False, status: Optional[str] = None,
+                             page_size: Optional[int] = None, cursor: Optional[str] = None,
+                             needs_enrollment: bool = False, columns: str = '*') -> List[Dict]:
+        """Get face enrollment status for all users
+        
+        Filters (has_face, status, needs_enrollment) run on the database side. When
+        page_size is set, rows are returned in user_detail_id order starting after
+        the given cursor.
+        """
         try:
             # Use the view we created
-            response = self.supabase.table('user_face_status').select('*').execute()
+            query = self.supabase.table('user_face_status').select(columns)
+            
+            # Filter out users without a face image on the database side
+            # (neq also excludes NULL, since NULL <> '' is not true)
+            if has_face or needs_enrollment:
+                query = query.neq('faceScannedUrl', '')
+            if needs_enrollment:
+                query = query.neq('enrollment_status', 'enrolled')
+            if status:
+                query = query.eq('enrollment_status', status)
+            
+            # Keyset pagination on user_detail_id
+            if page_size:
+                if cursor:
+                    query = query.gt('user_detail_id', cursor)
+                query = query.order('user_detail_id').limit(page_size)
+            
+            response = query.execute()
             
             if response.data:
                 return response.data
@@ -425,7 +505,6 @@ class SupabaseService:
         except Exception as e:
             logger.error(f"Error getting user face status: {e}")
             return []
-            return False
     
     def log_face_recognition(self, user_id: str, recognition_data: Dict) -> bool:
         """Log a face recognition event"""
@@ -457,7 +536,36 @@ class SupabaseService:
             logger.error(f"Error logging face recognition: {e}")
             return False
     
+    def get_user_count(self) -> Optional[int]:
+        """Count user_details rows without transferring them (exact count, zero rows)"""
+        try:
+            response = self.supabase.table('user_details').select('id', count='exact').limit(0).execute()
+            return response.count
+        except Exception as e:
+            logger.error("Error counting users: %s", e)
+            return None
+    
     def get_all_users_with_profiles(self) -> Optional[List[Dict]]:
+        """Get all users with their profile information, reusing a fetch younger than USERS_CACHE_TTL
+        
+        Concurrent callers wait on the lock and share a single fetch.
+        """
+        with self._users_cache_lock:
+            fetched_at, users = self._users_cache
+            if users is not None and time.monotonic() - fetched_at < USERS_CACHE_TTL:
+                return users
+            
+            users = self._fetch_all_users_with_profiles()
+            if users is not None:
+                self._users_cache = (time.monotonic(), users)
+            return users
+    
+    def invalidate_users_cache(self):
+        """Make the next get_all_users_with_profiles() call fetch fresh data"""
+        with self._users_cache_lock:
+            self._users_cache = (0.0, None)
+    
+    def _fetch_all_users_with_profiles(self) -> Optional[List[Dict]]:
         """Get all users with their profile information - works with user_details and user_accounts tables"""
         try:
             logger.info("Fetching users using actual database schema (user_details + user_accounts)")
@@ -616,7 +724,7 @@ class SupabaseService:
                     'status': 'PRESENT'
                 }
                 
-                response = self.supabase.table('attendance').insert(attendance_data).execute()
+                self.supabase.table('attendance').insert(attendance_data).execute()
                 
                 logger.info(f"NEW attendance marked for user {user_id} - {user_data.get('firstName', '')} {user_data.get('lastName', '')} via face recognition (attempt {attempt + 1})")
                 return {
@@ -883,5 +991,9 @@ class SupabaseService:
                 'data': [],
                 'count': 0
             }
-    
 
+
+@functools.lru_cache(maxsize=1)
+def get_supabase_service() -> SupabaseService:
+    """Get the shared SupabaseService instance (created on first use)"""
+    return SupabaseService()
@@ -4,64 +4,100 @@ Complete test script for the integrated face recognition system
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 import json
-import sys
 
 BASE_URL = "http://localhost:5000"
 
-def test_endpoint(endpoint, method="GET", data=None, description=""):
-    """Test a specific endpoint with detailed output"""
+# Shared session so every endpoint test reuses the same keep-alive connection
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64,
+                       max_retries=Retry(total=3, backoff_factor=0.3))
+SESSION.mount('http://', _adapter)
+SESSION.mount('https://', _adapter)
+
+def send_request(endpoint, method="GET", data=None):
+    """Send a request to an endpoint, returning (response, error)"""
     url = f"{BASE_URL}{endpoint}"
     
+    try:
+        if method == "GET":
+            response = SESSION.get(url)
+        elif method == "POST":
+            response = SESSION.post(url, json=data)
+        elif method == "DELETE":
+            response = SESSION.delete(url)
+        return response, None
+    except Exception as e:
+        return None, e
+
+def report_response(endpoint, method, description, response, error):
+    """Print the detailed output for a finished endpoint request"""
     print(f"\n{'='*70}")
     print(f"Testing: {method} {endpoint}")
     if description:
         print(f"Description: {description}")
     print(f"{'='*70}")
     
-    try:
-        if method == "GET":
-            response = requests.get(url)
-        elif method == "POST":
-            response = requests.post(url, json=data)
-        elif method == "DELETE":
-            response = requests.delete(url)
-        
-        print(f"Status Code: {response.status_code}")
-        
+    if error is not None:
+        print(f"❌ Error: {error}")
+        return None, None
+    
+    print(f"Status Code: {response.status_code}")
+    
+    # Only attempt a JSON parse when the server says the body is JSON
+    if 'json' in response.headers.get('Content-Type', ''):
         try:
             result = response.json()
             print("Response:")
             print(json.dumps(result, indent=2))
             return response.status_code, result
-        except:
-            print(f"Response (non-JSON): {response.text}")
-            return response.status_code, response.text
-            
-    except Exception as e:
-        print(f"❌ Error: {e}")
-        return None, None
+        except ValueError:
+            pass
+    
+    print(f"Response (non-JSON): {response.text[:200]}")
+    return response.status_code, response.text
+
+def test_endpoint(endpoint, method="GET", data=None, description=""):
+    """Test a specific endpoint with detailed output"""
+    response, error = send_request(endpoint, method, data)
+    return report_response(endpoint, method, description, response, error)
+
+def test_endpoints_parallel(probes):
+    """Test independent GET endpoints concurrently, reporting them in order
+    
+    probes is a list of (endpoint, description) tuples.
+    """
+    with ThreadPoolExecutor(max_workers=len(probes)) as executor:
+        responses = list(executor.map(lambda probe: send_request(probe[0]), probes))
+    
+    return [
+        report_response(endpoint, "GET", description, response, error)
+        for (endpoint, description), (response, error) in zip(probes, responses)
+    ]
 
 def main():
     """Run comprehensive tests"""
     print("🚀 Face Recognition System - Complete Integration Test")
     print("="*70)
     
-    # Test 1: Basic connectivity
-    test_endpoint("/", "GET", description="Welcome message with all endpoints")
-    test_endpoint("/health", "GET", description="Health check")
-    
-    # Test 2: Database integration
-    test_endpoint("/face-status", "GET", description="Get face enrollment status from database")
+    # Test 1 & 2: Basic connectivity and database integration (independent probes)
+    test_endpoints_parallel([
+        ("/", "Welcome message with all endpoints"),
+        ("/health", "Health check"),
+        ("/face-status", "Get face enrollment status from database"),
+    ])
     
     # Test 3: Sync existing faces from database
     test_endpoint("/sync-faces-from-db", "POST", description="Process existing face images from user_details table")
     
-    # Test 4: Check status after sync
-    test_endpoint("/face-status", "GET", description="Check status after syncing")
-    
-    # Test 5: List enrolled faces
-    test_endpoint("/faces", "GET", description="List all enrolled faces")
+    # Test 4 & 5: Check status after sync (with the enrolled face count) and list enrolled faces
+    test_endpoints_parallel([
+        ("/face-status?include_faces_count=1", "Check status and enrolled face count after syncing"),
+        ("/faces", "List all enrolled faces"),
+    ])
     
     # Test 6: Test face recognition (if you have enrolled faces)
     print("\n" + "="*70)
@@ -0,0 +1,4 @@
+"""WSGI entry point for process-based servers, e.g. `gunicorn -c gunicorn.conf.py wsgi:app`"""
+from src.flask_app import app
+
+__all__ = ['app']